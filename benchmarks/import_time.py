@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Copyright (C) 2017-2020  Silvio Ankermann
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of version 3 of the GNU
+# General Public License as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+
+# Measures how long the remote takes to start and answer git-annex up to
+# PREPARE, which every process spawned by git-annex goes through. Fails if
+# that loads one of the libraries which are meant to be imported only once
+# there is something to do, or if it takes longer than --max-ms.
+#
+#   python3 benchmarks/import_time.py [--runs 10] [--max-ms 150]
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('drivelib', 'googleapiclient', 'google', 'oauth2client', 'httplib2',
+                 'git', 'tenacity', 'humanfriendly', 'distutils')
+# What git-annex sends to a new process before PREPARE. The remote exits
+# once the input ends.
+HANDSHAKE = "EXTENSIONS INFO ASYNC\nGETCOST\nGETAVAILABILITY\n"
+REMOTE = "from git_annex_remote_googledrive.run import main; main()"
+
+def run(code: str, importtime: bool = False) -> subprocess.CompletedProcess:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    args = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    return subprocess.run(args, input=HANDSHAKE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, env=env, check=True)
+
+def timed(code: str, runs: int) -> float:
+    times = list()
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(code)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def imported_modules(code: str) -> list:
+    # (cumulative microseconds, module) for every module imported
+    modules = list()
+    for line in run(code, importtime=True).stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative), name.strip()))
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup time of the remote")
+    parser.add_argument('--runs', type=int, default=10, help='Number of runs to take the median of')
+    parser.add_argument('--max-ms', type=float, help='Fail if the handshake takes longer than this'
+                                                     ' on top of the interpreter startup')
+    args = parser.parse_args()
+
+    interpreter = timed("pass", args.runs)
+    handshake = timed(REMOTE, args.runs)
+    overhead_ms = (handshake - interpreter) * 1000
+    print("Interpreter startup:   {:7.1f} ms".format(interpreter * 1000))
+    print("Startup to PREPARE:    {:7.1f} ms ({:.1f} ms for the remote)".format(handshake * 1000, overhead_ms))
+
+    modules = imported_modules(REMOTE)
+    print("Slowest imports:")
+    for cumulative, name in sorted(modules, reverse=True)[:10]:
+        print("  {:7.1f} ms  {}".format(cumulative / 1000, name))
+
+    failed = False
+    heavy = sorted({name.split('.')[0] for _, name in modules} & set(HEAVY_MODULES))
+    if heavy:
+        print("Imported before PREPARE, but shouldn't be:", ", ".join(heavy))
+        failed = True
+    if args.max_ms is not None and overhead_ms > args.max_ms:
+        print("Startup takes longer than {} ms".format(args.max_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
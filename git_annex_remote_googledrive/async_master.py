@@ -0,0 +1,164 @@
+# Copyright (C) 2017-2020  Silvio Ankermann
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of version 3 of the GNU
+# General Public License as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+
+import os
+import sys
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from annexremote import Master
+from annexremote.annexremote import Protocol
+from annexremote import UnsupportedRequest
+
+DEFAULT_WORKERS = 32
+
+# Reply telling git-annex that a request failed, by request and the number
+# of its arguments that go into the reply
+FAILURE_REPLIES = {
+    "TRANSFER": ("TRANSFER-FAILURE", 2),
+    "TRANSFEREXPORT": ("TRANSFER-FAILURE", 2),
+    "CHECKPRESENT": ("CHECKPRESENT-UNKNOWN", 1),
+    "CHECKPRESENTEXPORT": ("CHECKPRESENT-UNKNOWN", 1),
+    "REMOVE": ("REMOVE-FAILURE", 1),
+    "REMOVEEXPORT": ("REMOVE-FAILURE", 1),
+    "REMOVEEXPORTDIRECTORY": ("REMOVEEXPORTDIRECTORY-FAILURE", 0),
+    "RENAMEEXPORT": ("RENAMEEXPORT-FAILURE", 1),
+    "WHEREIS": ("WHEREIS-FAILURE", 0),
+}
+
+class _JobInput():
+    # Replies of git-annex to a question asked in the context of a job are
+    # routed to the thread running that job. Everything else reads from
+    # the real input.
+    def __init__(self, master):
+        self.master = master
+
+    def readline(self):
+        job = getattr(self.master._local, "job", None)
+        if job is None:
+            return self.master.raw_input.readline()
+        return self.master._jobs[job].get()
+
+class AsyncMaster(Master):
+    """
+    Master implementing the ASYNC protocol extension.
+
+    If git-annex offers it, a single process serves all jobs of a
+    `git annex -J` run on a thread pool. Requests and replies are tagged
+    with the job number ("J n ..."). Without the extension, it behaves
+    exactly like Master.
+    """
+
+    def __init__(self, output=sys.stdout, workers=DEFAULT_WORKERS):
+        super().__init__(output)
+        self.workers = workers
+        self.async_enabled = False
+        self._local = threading.local()
+        self._send_lock = threading.Lock()
+        self._jobs = dict()
+        self._job_protocols = dict()
+
+    def Listen(self, input=sys.stdin):
+        self.raw_input = input
+        self.input = _JobInput(self)
+        self._send(self.protocol.version)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                line = self.raw_input.readline()
+                if not line:
+                    break
+                line = line.rstrip()
+                if self.async_enabled and line.startswith("J "):
+                    self._dispatch(executor, line)
+                elif line.startswith("EXTENSIONS"):
+                    self._run(self.protocol, line)
+                    if "ASYNC" in self.protocol.extensions and self.workers > 1:
+                        self.async_enabled = True
+                        self._send("EXTENSIONS ASYNC")
+                    else:
+                        self._send("EXTENSIONS")
+                else:
+                    reply = self._run(self.protocol, line)
+                    if reply:
+                        self._send(reply)
+
+    def _dispatch(self, executor, line):
+        _, job, request = line.split(" ", 2)
+        if job in self._jobs:
+            # git-annex only sends a new request to a job once the previous
+            # one has been answered, so this is a reply to a question
+            self._jobs[job].put(request + "\n")
+            return
+        protocol = self._job_protocols.setdefault(job, Protocol(self.remote))
+        protocol.extensions = self.protocol.extensions
+        if request.startswith("EXPORT "):
+            # Doesn't get a reply and must be stored before the next request
+            # of this job arrives
+            protocol.command(request)
+            return
+        self._jobs[job] = queue.Queue()
+        executor.submit(self._run_job, job, protocol, request)
+
+    def _run_job(self, job, protocol, request):
+        self._local.job = job
+        try:
+            reply = self._run(protocol, request)
+        finally:
+            del self._jobs[job]
+        if reply:
+            self._send(reply)
+        self._local.job = None
+
+    def _run(self, protocol, line):
+        try:
+            return protocol.command(line)
+        except UnsupportedRequest:
+            return "UNSUPPORTED-REQUEST"
+        except Exception as e:
+            for tb_line in traceback.format_exc().splitlines():
+                self.debug(tb_line)
+            reply = self._failure_reply(line, e)
+            if reply is not None:
+                # Only this request failed. The others go on.
+                return reply
+            self.error(e)
+            if threading.current_thread() is threading.main_thread():
+                raise SystemExit
+            # Same as above, but SystemExit would only end the worker thread.
+            # os._exit skips the cleanup at the end of main, so do it here.
+            shutdown = getattr(self.remote, "shutdown", None)
+            if shutdown is not None:
+                try:
+                    shutdown()
+                except Exception:
+                    pass
+            os._exit(1)
+
+    @staticmethod
+    def _failure_reply(line, error):
+        # The failure reply to the request, or None if it has none
+        request, *args = line.split(" ")
+        if request not in FAILURE_REPLIES:
+            return None
+        reply, nargs = FAILURE_REPLIES[request]
+        if len(args) < nargs:
+            return None
+        message = " ".join(str(error).split()) or error.__class__.__name__
+        return " ".join([reply] + args[:nargs] + [message])
+
+    def _send(self, *args, **kwargs):
+        job = getattr(self._local, "job", None)
+        with self._send_lock:
+            if job is None:
+                print(*args, file=self.output, **kwargs)
+            else:
+                print("J", job, *args, file=self.output, **kwargs)
+            self.output.flush()
@@ -0,0 +1,73 @@
+# Copyright (C) 2017-2020  Silvio Ankermann
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of version 3 of the GNU
+# General Public License as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+
+from collections import namedtuple
+from functools import partial
+
+import hashlib
+
+KeyDigest = namedtuple("KeyDigest", ["backend", "new", "hexdigest"])
+
+# git-annex backends whose hash hashlib can compute. The E variants only
+# differ by the extension appended to the key.
+BACKEND_HASHES = {
+    "MD5":          hashlib.md5,
+    "SHA1":         hashlib.sha1,
+    "SHA224":       hashlib.sha224,
+    "SHA256":       hashlib.sha256,
+    "SHA384":       hashlib.sha384,
+    "SHA512":       hashlib.sha512,
+    "SHA3_224":     hashlib.sha3_224,
+    "SHA3_256":     hashlib.sha3_256,
+    "SHA3_384":     hashlib.sha3_384,
+    "SHA3_512":     hashlib.sha3_512,
+    "BLAKE2B160":   partial(hashlib.blake2b, digest_size=20),
+    "BLAKE2B224":   partial(hashlib.blake2b, digest_size=28),
+    "BLAKE2B256":   partial(hashlib.blake2b, digest_size=32),
+    "BLAKE2B384":   partial(hashlib.blake2b, digest_size=48),
+    "BLAKE2B512":   partial(hashlib.blake2b, digest_size=64),
+    "BLAKE2S160":   partial(hashlib.blake2s, digest_size=20),
+    "BLAKE2S224":   partial(hashlib.blake2s, digest_size=28),
+    "BLAKE2S256":   partial(hashlib.blake2s, digest_size=32),
+}
+
+def key_digest(key: str) -> KeyDigest:
+    # Returns the hash a key carries of its content or None if it doesn't
+    # carry one we can compute. Chunks of a bigger key carry the hash of the
+    # whole content, so they don't count.
+    fields, _, name = key.partition("--")
+    fields = fields.split("-")
+    backend = fields[0]
+    if backend.endswith("E") and backend[:-1] in BACKEND_HASHES:
+        backend = backend[:-1]
+        name = name.split(".", 1)[0]
+    if backend not in BACKEND_HASHES or not name:
+        return None
+    if any(field[:1] in ("S", "C") for field in fields[1:]):
+        return None
+    new = BACKEND_HASHES[backend]
+    hexdigest = name.lower()
+    if len(hexdigest) != new().digest_size*2 or any(c not in "0123456789abcdef" for c in hexdigest):
+        return None
+    return KeyDigest(backend, new, hexdigest)
+
+def md5_from_key(key: str) -> str:
+    # MD5 and MD5E keys carry the MD5 of their content. Returns None for all
+    # other keys.
+    digest = key_digest(key)
+    if digest is None or digest.backend != "MD5":
+        return None
+    return digest.hexdigest
+
+def hash_file(filename: str, new: callable = hashlib.md5) -> str:
+    hasher = new()
+    with open(filename, 'rb') as fh:
+        for data in iter(lambda: fh.read(4*1024**2), b""):
+            hasher.update(data)
+    return hasher.hexdigest()
@@ -9,60 +9,32 @@
 
 import os, traceback, sys
 import json
+import threading
 from pathlib import Path
 
+# Only what is needed to answer git-annex before PREPARE is imported here.
+# git-annex starts a process for every command and job, many of which never
+# get to transfer anything, so drivelib, the Google libraries, tenacity and
+# humanfriendly are imported where they are first used.
 
 from . import __version__
 from . import __name__ as MODULENAME
 from annexremote import __version__ as annexremote_version
-from drivelib import __version__ as drivelib_version
 from . import _default_client_id as DEFAULT_CLIENT_ID
 
-
-from drivelib import GoogleDrive
-from drivelib import Credentials
-from drivelib.errors import NumberOfChildrenExceededError
-
-from .keys import Key, NodirRemoteRoot, NestedRemoteRoot, LowerRemoteRoot, DirectoryRemoteRoot, MixedRemoteRoot
-from .keys import ExportRemoteRoot, ExportKey
-from .keys import HasSubdirError, NotAFileError, NotAuthenticatedError
-
-
-from oauth2client.client import OAuth2Credentials
-from google.auth.exceptions import RefreshError
-
-from googleapiclient.errors import HttpError
 from json.decoder import JSONDecodeError
 
 from functools import wraps
 
-from tenacity import Retrying, retry
-from tenacity import retry_if_exception_type
-from tenacity import wait_exponential, wait_fixed
-from tenacity import stop_after_attempt
-
 import annexremote
 from annexremote import RemoteError
 from annexremote import ProtocolError
 
-from pathlib import Path
 import logging
 
-import humanfriendly
-
 def NotAFolderError(Exception):
     pass
 
-retry_conditions = {
-        'wait': wait_exponential(multiplier=1, max=10),
-        'retry': (
-            retry_if_exception_type(HttpError) |
-            retry_if_exception_type(ConnectionResetError)
-        ),
-        'stop': stop_after_attempt(5),
-        'reraise': True,
-    }
-    
 def send_version_on_error(f):
     @wraps(f)
     def send_version_wrapper(self, *args, **kwargs):
@@ -74,12 +46,52 @@ def send_version_on_error(f):
 
     return send_version_wrapper
 
+def debug_connections(f):
+    @wraps(f)
+    def debug_connections_wrapper(self, *args, **kwargs):
+        try:
+            return f(self, *args, **kwargs)
+        finally:
+            stats = self._root.connection_stats() if getattr(self, '_root', None) else None
+            if stats:
+                self.annex.debug("HTTP: {}".format(stats))
+
+    return debug_connections_wrapper
+
+def retry_transient(f):
+    @wraps(f)
+    def retry_wrapper(self, *args, **kwargs):
+        from tenacity import Retrying
+        from .retrying import retry_conditions
+        return Retrying(**retry_conditions)(f, self, *args, **kwargs)
+
+    return retry_wrapper
+
+def fail_on_quota(f):
+    # Running out of a budget only fails the transfer at hand
+    @wraps(f)
+    def fail_on_quota_wrapper(self, *args, **kwargs):
+        from .throttle import BudgetExhaustedError, UploadQuotaExceededError
+        try:
+            return f(self, *args, **kwargs)
+        except (UploadQuotaExceededError, BudgetExhaustedError) as e:
+            raise RemoteError(str(e))
+
+    return fail_on_quota_wrapper
+
 class GoogleRemote(annexremote.ExportRemote):
 
     def __init__(self, annex):
         super().__init__(annex)
+        self._lock = threading.RLock()
         self.DEFAULT_CHUNKSIZE = "5MiB"
-        self.configs = {
+
+    def listconfigs(self):
+        from .transfer import DEFAULT_CONNECTIONS, DEFAULT_BUFFER_SIZE
+        from .transport import DEFAULT_POOL_SIZE, DEFAULT_PER_HOST
+        from .throttle import DEFAULT_MAX_REQUESTS
+        import humanfriendly
+        return {
             'prefix': "The path to the folder that will be used for the remote."
                         " If it doesn't exist, it will be created.",
             'layout': "How the keys should be stored in the remote folder."
@@ -99,60 +111,131 @@ class GoogleRemote(annexremote.ExportRemote):
                         " Smaller values meaning less data to be re-transmitted when network"
                         " connectivity is interrupted and result in a finer progress feedback."
                         " Bigger values create slightly less overhead and are therefore"
-                        " somewhat more efficient."
+                        " somewhat more efficient. Set to `auto` to have the chunksize"
+                        " adapted to the measured throughput during each transfer."
                         " Default: {}".format(self.DEFAULT_CHUNKSIZE),
             'mute-api-lockdown-warning':
                         "Set to 'true' if you don't want to see the warning.",
             'token':    "Token file that was created by `git-annex-remote-googledrive setup`",
             'auto_fix_full':    "`yes` if the remote should try to fix full-folder issues"
                                 " automatically. See https://github.com/Lykos153/git-annex-remote-googledrive#fix-full-folder",
+            'listing':  "Set to `full` to list the whole remote folder once when git-annex"
+                        " starts the remote. All further key lookups are then answered"
+                        " without asking Google Drive. Recommended for operations on"
+                        " many keys like `git annex sync --content`. Set to `incremental`"
+                        " to keep a local index of the remote which is updated with the"
+                        " changes since the last run instead of listing everything again.",
+            'download-connections':
+                        "Number of connections used to download big files. Each of them"
+                        " fetches a different part of the file."
+                        " Default: {}".format(DEFAULT_CONNECTIONS),
+            'upload-buffer':
+                        "Memory used per upload for reading ahead of what is being sent."
+                        " Chunks are limited to half of it. Also limits the memory a download"
+                        " uses for the parts it is fetching."
+                        " Default: {}".format(humanfriendly.format_size(DEFAULT_BUFFER_SIZE, binary=True)),
+            'http-pool-size':
+                        "Maximum number of HTTP connections to Google kept open by the remote."
+                        " They are shared by all its requests."
+                        " Default: {}".format(DEFAULT_POOL_SIZE),
+            'http-per-host':
+                        "Maximum number of requests to the same host at a time."
+                        " Default: {}".format(DEFAULT_PER_HOST),
+            'max-requests':
+                        "Maximum number of requests to Google Drive at a time, shared by all"
+                        " processes of the remote in this repository. Below it, the number"
+                        " grows while Drive answers normally and is halved when Drive"
+                        " reports rate limiting."
+                        " Default: {}".format(DEFAULT_MAX_REQUESTS),
+            'max-qps':
+                        "Maximum number of requests to Google Drive per second, shared by all"
+                        " processes of the remote in this repository. Default: unlimited",
+            'upload-per-day':
+                        "Maximum amount of data uploaded per day, shared by all processes"
+                        " of the remote in this repository. Uploads are slowed down to"
+                        " stay within it and fail if that would take too long."
+                        " Example: `750GB`. Default: unlimited",
         }
 
     @property
     def root(self):
         if not hasattr(self, '_root') or self._root is None: # pylint: disable=access-member-before-definition
-            prefix = self.annex.getconfig('prefix')
-            root_id = self.annex.getconfig('root_id')
-            exporttree = self.annex.getconfig('exporttree')
-            if exporttree == "yes":
-                root_class = ExportRemoteRoot
+            # Jobs of an ASYNC session may ask for the root at the same time
+            with self._lock:
+                if not hasattr(self, '_root') or self._root is None:
+                    self._root = self._open_root()
+        return self._root
+
+    def _open_root(self):
+        from . import transport
+        from .transport import DEFAULT_POOL_SIZE, DEFAULT_PER_HOST
+        from .throttle import ConcurrencyController, RateLimiter, DEFAULT_MAX_REQUESTS
+        from .keys import RemoteRoot, NodirRemoteRoot, NestedRemoteRoot, LowerRemoteRoot, MixedRemoteRoot
+        from .keys import ExportRemoteRoot, NotAuthenticatedError
+        from google.auth.exceptions import RefreshError
+
+        transport.configure(
+                    size=self._int_config('http-pool-size', DEFAULT_POOL_SIZE),
+                    per_host=self._int_config('http-per-host', DEFAULT_PER_HOST),
+                    controller=ConcurrencyController(
+                                    self.throttle_state,
+                                    maximum=self._int_config('max-requests', DEFAULT_MAX_REQUESTS),
+                                ),
+                    rate_limiter=RateLimiter(
+                                    self.throttle_state,
+                                    qps=self.max_qps,
+                                    bytes_per_day=self.upload_per_day,
+                                ),
+                    quota=self.upload_quota,
+                )
+        prefix = self.annex.getconfig('prefix')
+        root_id = self.annex.getconfig('root_id')
+        exporttree = self.annex.getconfig('exporttree')
+        if exporttree == "yes":
+            root_class = ExportRemoteRoot
+        else:
+            layout_mapping = {
+                'nodir':    NodirRemoteRoot,
+                'nested':   NestedRemoteRoot,
+                'lower':    LowerRemoteRoot,
+                #'directory': DirectoryRemoteRoot,
+                'mixed':    MixedRemoteRoot,
+            }
+            root_class = layout_mapping.get(self.layout, None)
+            if root_class is None:
+                raise RemoteError("`layout` must be one of {}".format(list(layout_mapping.keys())))
+
+        if self.credentials is None:
+            raise RemoteError("Stored credentials are invalid. Please re-run `git-annex-remote-googledrive setup` and `git annex enableremote <remotename>`")
+
+        try:
+            if prefix:
+                root = root_class.from_path(self.credentials, prefix, annex=self.annex, uuid=self.uuid, local_appdir=self.local_appdir)
             else:
-                layout_mapping = {
-                    'nodir':    NodirRemoteRoot,
-                    'nested':   NestedRemoteRoot,
-                    'lower':    LowerRemoteRoot,
-                    #'directory': DirectoryRemoteRoot,
-                    'mixed':    MixedRemoteRoot,
-                }
-                root_class = layout_mapping.get(self.layout, None)
-                if root_class is None:
-                    raise RemoteError("`layout` must be one of {}".format(list(layout_mapping.keys())))
-
-            if self.credentials is None:
-                raise RemoteError("Stored credentials are invalid. Please re-run `git-annex-remote-googledrive setup` and `git annex enableremote <remotename>`")
+                root = root_class.from_id(self.credentials, root_id, annex=self.annex, uuid=self.uuid, local_appdir=self.local_appdir)
+        except JSONDecodeError:
+            raise RemoteError("Access token invalid, please re-run `git-annex-remote-googledrive setup`")
+        except (NotAuthenticatedError, RefreshError):
+            raise RemoteError("Failed to authenticate with Google. Please run 'git-annex-remote-googledrive setup'.")
+        except FileNotFoundError:
+            if prefix:
+                raise RemoteError("Prefix {} does not exist or does not point to a folder.".format(prefix))
+            else:
+                raise RemoteError("File ID {} does not exist or does not point to a folder.".format(root_id))
 
-            try:
-                if prefix:
-                    root = root_class.from_path(self.credentials, prefix, annex=self.annex, uuid=self.uuid, local_appdir=self.local_appdir)
-                else:
-                    root = root_class.from_id(self.credentials, root_id, annex=self.annex, uuid=self.uuid, local_appdir=self.local_appdir)
-            except JSONDecodeError:
-                raise RemoteError("Access token invalid, please re-run `git-annex-remote-googledrive setup`")
-            except (NotAuthenticatedError, RefreshError):
-                raise RemoteError("Failed to authenticate with Google. Please run 'git-annex-remote-googledrive setup'.")
-            except FileNotFoundError:
-                if prefix:
-                    raise RemoteError("Prefix {} does not exist or does not point to a folder.".format(prefix))
-                else:
-                    raise RemoteError("File ID {} does not exist or does not point to a folder.".format(root_id))
-
-            if root.id != root_id and not (hasattr(self, 'isinitremote') and self.isinitremote is True):
-                raise RemoteError("ID of root folder changed. Was the repo moved? Please check remote and re-run git annex enableremote")
-
-            self.credentials = root.creds()
-            
-            self._root = root
-        return self._root
+        if root.id != root_id and not (hasattr(self, 'isinitremote') and self.isinitremote is True):
+            raise RemoteError("ID of root folder changed. Was the repo moved? Please check remote and re-run git annex enableremote")
+
+        self.credentials = root.creds()
+
+        listing = self.annex.getconfig('listing')
+        if isinstance(root, RemoteRoot):
+            if listing == "full":
+                root.load_listing()
+            elif listing == "incremental":
+                root.sync_index()
+
+        return root
 
     @property
     def encryption(self):
@@ -200,7 +283,11 @@ class GoogleRemote(annexremote.ExportRemote):
         else:
             return_dict['remote root-id'] = self.annex.getconfig("root_id")
         return_dict['remote layout'] = self.layout
-        return_dict['transfer chunk size'] = humanfriendly.format_size(self.chunksize, binary=True)
+        import humanfriendly
+        if self.chunksize is None:
+            return_dict['transfer chunk size'] = "auto"
+        else:
+            return_dict['transfer chunk size'] = humanfriendly.format_size(self.chunksize, binary=True)
         return return_dict
 
     @info.setter
@@ -210,8 +297,14 @@ class GoogleRemote(annexremote.ExportRemote):
     @property
     def chunksize(self):
         if not hasattr(self, '_chunksize'):
+            import humanfriendly
             try:
                 transferchunk = self.annex.getconfig('transferchunk')
+                if transferchunk == "auto":
+                    # Picked per chunk by the transfer
+                    self._chunksize = None
+                    self.annex.debug("Using adaptive chunksize")
+                    return self._chunksize
                 self._chunksize = humanfriendly.parse_size(transferchunk)
                 self.annex.debug("Using chunksize: {}".format(transferchunk))
             except humanfriendly.InvalidSize:
@@ -219,9 +312,69 @@ class GoogleRemote(annexremote.ExportRemote):
                 self._chunksize = humanfriendly.parse_size(self.DEFAULT_CHUNKSIZE)
         return self._chunksize
 
+    @property
+    def download_connections(self):
+        if not hasattr(self, '_download_connections'):
+            from .transfer import DEFAULT_CONNECTIONS
+            self._download_connections = max(1, self._int_config('download-connections', DEFAULT_CONNECTIONS))
+        return self._download_connections
+
+    def _int_config(self, name, default):
+        try:
+            return int(self.annex.getconfig(name))
+        except ValueError:
+            return default
+
+    @property
+    def upload_buffer(self):
+        if not hasattr(self, '_upload_buffer'):
+            import humanfriendly
+            from .transfer import DEFAULT_BUFFER_SIZE
+            try:
+                self._upload_buffer = humanfriendly.parse_size(self.annex.getconfig('upload-buffer'))
+            except humanfriendly.InvalidSize:
+                self._upload_buffer = DEFAULT_BUFFER_SIZE
+        return self._upload_buffer
+
+    @property
+    def throttle_state(self):
+        # Shared by all processes of this remote in this repository. Other
+        # remotes may use other accounts with limits of their own.
+        if not hasattr(self, '_throttle_state'):
+            from .throttle import SharedState
+            self._throttle_state = SharedState(self.local_appdir / self.uuid / "throttle.json")
+        return self._throttle_state
+
+    @property
+    def upload_quota(self):
+        if not hasattr(self, '_upload_quota'):
+            from .throttle import UploadQuota
+            self._upload_quota = UploadQuota(self.throttle_state)
+        return self._upload_quota
+
+    @property
+    def max_qps(self):
+        if not hasattr(self, '_max_qps'):
+            try:
+                self._max_qps = float(self.annex.getconfig('max-qps')) or None
+            except ValueError:
+                self._max_qps = None
+        return self._max_qps
+
+    @property
+    def upload_per_day(self):
+        if not hasattr(self, '_upload_per_day'):
+            import humanfriendly
+            try:
+                self._upload_per_day = humanfriendly.parse_size(self.annex.getconfig('upload-per-day')) or None
+            except humanfriendly.InvalidSize:
+                self._upload_per_day = None
+        return self._upload_per_day
+
     @property
     def credentials(self):
         if not hasattr(self, '_credentials'):
+            from drivelib import Credentials
             json_creds = self.annex.getcreds('credentials')['user']
             try:
                 self._credentials = Credentials.from_json(json_creds)
@@ -232,12 +385,14 @@ class GoogleRemote(annexremote.ExportRemote):
 
     @credentials.setter
     def credentials(self, creds):
+        from drivelib import Credentials
         if creds != self.credentials:
             self._credentials = creds
             self.annex.setcreds('credentials', ''.join(Credentials.to_json(creds).split()), '')
 
     @send_version_on_error
     def initremote(self):
+        from drivelib import Credentials
         self.isinitremote = True
         self._send_version()
         prefix = self.annex.getconfig('prefix')
@@ -270,6 +425,14 @@ class GoogleRemote(annexremote.ExportRemote):
         self.isinitremote = False
 
     def prepare(self):
+        with self._lock:
+            # With ASYNC, every job sends its own PREPARE
+            if getattr(self, '_prepared', False):
+                return
+            self._prepare()
+            self._prepared = True
+
+    def _prepare(self):
         self._send_version()
 
         if self.annex.getconfig('mute-api-lockdown-warning') != "true" and \
@@ -282,9 +445,19 @@ class GoogleRemote(annexremote.ExportRemote):
             self._info("You can mute this warning by issuing 'git annex enableremote <remote-name> mute-api-lockdown-warning=true'")
             self._info("======")
 
+        if self.annex.getconfig('listing'):
+            # Do the listing now instead of during the first request
+            self.root
+
     @send_version_on_error
-    @retry(**retry_conditions)
+    @fail_on_quota
+    @debug_connections
+    @retry_transient
     def transfer_store(self, key, fpath):
+        from drivelib.errors import NumberOfChildrenExceededError
+        from .keys import StaleFolderError
+        # Don't even look for the folder if the upload can't succeed
+        self.upload_quota.check()
         fpath = Path(fpath)
         new_path = self.local_appdir / self.uuid / "tmp" / key
         if new_path.exists():
@@ -302,6 +475,7 @@ class GoogleRemote(annexremote.ExportRemote):
             self.root.new_key(key).upload(
                             str(upload_path), 
                             chunksize=self.chunksize,
+                            buffer_size=self.upload_buffer,
                             progress_handler=self.annex.progress)
 
 
@@ -310,66 +484,76 @@ class GoogleRemote(annexremote.ExportRemote):
         except NumberOfChildrenExceededError:
             self.root.handle_full_folder()
             try_upload()
+        except StaleFolderError:
+            try_upload()
 
         new_path.unlink(missing_ok=True)
 
     @send_version_on_error
-    @retry(**retry_conditions)
+    @debug_connections
+    @retry_transient
     def transfer_retrieve(self, key, fpath):
         self.root.get_key(key).download(
                     fpath, 
                     chunksize=self.chunksize,
+                    connections=self.download_connections,
+                    buffer_size=self.upload_buffer,
                     progress_handler=self.annex.progress)
     
     @send_version_on_error
-    @retry(**retry_conditions)
+    @retry_transient
     def checkpresent(self, key):
-        try:
-            self.root.get_key(key)
-            return True
-        except FileNotFoundError:
-            return False
+        return self.root.has_key(key)
 
     @send_version_on_error
-    @retry(**retry_conditions)
+    @retry_transient
     def remove(self, key):
         self.root.delete_key(key)
 
     @send_version_on_error
-    @retry(**retry_conditions)
+    @fail_on_quota
+    @debug_connections
+    @retry_transient
     def transferexport_store(self, key, fpath, name):
-        #TODO: if file already exists, compare md5sum
-        self.root.new_key(key, name).upload(
-                fpath,
-                chunksize=self.chunksize,
-                progress_handler=self.annex.progress
-        )
+        from .keys import StaleFolderError
+        self.upload_quota.check()
+        def try_upload():
+            self.root.new_key(key, name, local_filename=fpath).upload(
+                    fpath,
+                    chunksize=self.chunksize,
+                    buffer_size=self.upload_buffer,
+                    progress_handler=self.annex.progress
+            )
+
+        try:
+            try_upload()
+        except StaleFolderError:
+            try_upload()
 
     @send_version_on_error
-    @retry(**retry_conditions)
+    @debug_connections
+    @retry_transient
     def transferexport_retrieve(self, key, fpath, name):
         self.root.get_key(key, name).download(
             fpath,
             chunksize=self.chunksize,
+            connections=self.download_connections,
+            buffer_size=self.upload_buffer,
             progress_handler=self.annex.progress
         )
 
     @send_version_on_error
-    @retry(**retry_conditions)
+    @retry_transient
     def checkpresentexport(self, key, name):
-        try:
-            self.root.get_key(key, name)
-            return True
-        except FileNotFoundError:
-            return False
+        return self.root.has_key(key, name)
 
     @send_version_on_error
-    @retry(**retry_conditions)
+    @retry_transient
     def removeexport(self, key, name):
         self.root.delete_key(key, name)
 
     @send_version_on_error
-    @retry(**retry_conditions)
+    @retry_transient
     def removeexportdirectory(self, directory):
         try:
             self.root.delete_dir(directory)
@@ -377,10 +561,23 @@ class GoogleRemote(annexremote.ExportRemote):
             raise RemoteError("{} is a file. Not deleting".format(directory))
 
     @send_version_on_error
-    @retry(**retry_conditions)
+    @retry_transient
     def renameexport(self, key, name, new_name):
         self.root.rename_key(key, name, new_name)
             
+    def shutdown(self):
+        # git-annex is done with us. Use the time for housekeeping which
+        # would otherwise slow down the transfers.
+        root = getattr(self, '_root', None)
+        if root is None:
+            return
+        from .keys import RemoteRoot
+        if isinstance(root, RemoteRoot):
+            try:
+                root.migrate_misplaced()
+            except Exception as e:
+                logging.warning("Could not migrate keys to the current layout: %s", e)
+
     def _splitpath(self, filename):
         splitpath = filename.rsplit('/', 1)
         exportfile = dict()
@@ -393,9 +590,7 @@ class GoogleRemote(annexremote.ExportRemote):
         return exportfile
             
     def _send_version(self):
-        global __version__
-        global annexremote_version
-        global drivelib_version
+        from drivelib import __version__ as drivelib_version
         self.annex.debug("Running {} version {}".format(
                             MODULENAME,
                             __version__
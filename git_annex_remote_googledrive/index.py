@@ -0,0 +1,240 @@
+# Copyright (C) 2017-2020  Silvio Ankermann
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of version 3 of the GNU
+# General Public License as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+
+from __future__ import annotations #only > 3.7, better to find a different solution
+
+from pathlib import Path
+from os import PathLike
+from collections import namedtuple
+from typing import Union, Iterable
+from contextlib import contextmanager
+from functools import wraps
+
+import sqlite3
+import threading
+
+IndexEntry = namedtuple("IndexEntry", ["key", "file_id", "parent_id", "size", "md5"])
+FolderEntry = namedtuple("FolderEntry", ["id", "parent_id", "name", "path"])
+MisplacedEntry = namedtuple("MisplacedEntry", ["key", "file_id", "parent_id", "target_path"])
+
+def locked(f):
+    @wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return f(self, *args, **kwargs)
+    return wrapper
+
+class KeyIndex():
+    # Maps keys to the IDs of the Drive files holding them. Entries are only
+    # hints and have to be validated by the caller before being trusted.
+    def __init__(self, db_file: Union[str, PathLike]):
+        self.db_file = Path(db_file)
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        # git-annex may run several instances of the remote in parallel and
+        # each of them may use the index from several threads
+        self._lock = threading.RLock()
+        self.db = sqlite3.connect(str(self.db_file), timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS keys (
+                                key         TEXT PRIMARY KEY,
+                                file_id     TEXT NOT NULL,
+                                parent_id   TEXT,
+                                size        INTEGER,
+                                md5         TEXT
+                            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS keys_file_id ON keys (file_id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS keys_parent_id ON keys (parent_id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS keys_md5 ON keys (md5)")
+        # Folders below the remote root, with their path relative to it
+        self.db.execute("""CREATE TABLE IF NOT EXISTS folders (
+                                id          TEXT PRIMARY KEY,
+                                parent_id   TEXT,
+                                name        TEXT NOT NULL,
+                                path        TEXT NOT NULL
+                            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS folders_path ON folders (path)")
+        # Keys found outside the folder the layout expects them in
+        self.db.execute("""CREATE TABLE IF NOT EXISTS misplaced (
+                                key         TEXT PRIMARY KEY,
+                                file_id     TEXT NOT NULL,
+                                parent_id   TEXT,
+                                target_path TEXT
+                            )""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS state (
+                                name        TEXT PRIMARY KEY,
+                                value       TEXT
+                            )""")
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            else:
+                self.db.execute("COMMIT")
+
+    @locked
+    def get(self, key: str) -> IndexEntry:
+        row = self.db.execute(
+                    "SELECT key, file_id, parent_id, size, md5 FROM keys WHERE key = ?",
+                    (key,)
+                ).fetchone()
+        if row is None:
+            return None
+        return IndexEntry(*row)
+
+    @locked
+    def find_content(self, key: str, size: int, md5: str = None) -> list:
+        # Entries that may hold the same content, by key or by checksum
+        rows = self.db.execute(
+                    "SELECT key, file_id, parent_id, size, md5 FROM keys WHERE key = ? OR (md5 = ? AND size = ?)",
+                    (key, md5, size)
+                ).fetchall()
+        return [IndexEntry(*row) for row in rows]
+
+    @locked
+    def add(self, key: str, file_id: str, parent_id: str = None, size: int = None, md5: str = None):
+        self.db.execute(
+                    "INSERT OR REPLACE INTO keys (key, file_id, parent_id, size, md5) VALUES (?, ?, ?, ?, ?)",
+                    (key, file_id, parent_id, size, md5)
+                )
+
+    @locked
+    def add_many(self, entries: Iterable[IndexEntry]):
+        self.db.executemany(
+                    "INSERT OR REPLACE INTO keys (key, file_id, parent_id, size, md5) VALUES (?, ?, ?, ?, ?)",
+                    entries
+                )
+
+    @locked
+    def remove(self, key: str):
+        self.db.execute("DELETE FROM keys WHERE key = ?", (key,))
+
+    @locked
+    def remove_file(self, file_id: str):
+        self.db.execute("DELETE FROM keys WHERE file_id = ?", (file_id,))
+
+    @locked
+    def set_parent(self, file_id: str, parent_id: str):
+        self.db.execute("UPDATE keys SET parent_id = ? WHERE file_id = ?", (parent_id, file_id))
+
+    @locked
+    def get_folder(self, folder_id: str) -> FolderEntry:
+        row = self.db.execute(
+                    "SELECT id, parent_id, name, path FROM folders WHERE id = ?",
+                    (folder_id,)
+                ).fetchone()
+        if row is None:
+            return None
+        return FolderEntry(*row)
+
+    @locked
+    def get_folder_by_path(self, path: str) -> FolderEntry:
+        row = self.db.execute(
+                    "SELECT id, parent_id, name, path FROM folders WHERE path = ?",
+                    (path,)
+                ).fetchone()
+        if row is None:
+            return None
+        return FolderEntry(*row)
+
+    @locked
+    def folders(self) -> list:
+        rows = self.db.execute("SELECT id, parent_id, name, path FROM folders").fetchall()
+        return [FolderEntry(*row) for row in rows]
+
+    @locked
+    def add_folder(self, folder_id: str, parent_id: str, name: str, path: str):
+        old = self.get_folder(folder_id)
+        self.db.execute(
+                    "INSERT OR REPLACE INTO folders (id, parent_id, name, path) VALUES (?, ?, ?, ?)",
+                    (folder_id, parent_id, name, path)
+                )
+        if old is not None and old.path != path:
+            # Folder was moved or renamed. Its subfolders move along.
+            prefix = old.path + "/"
+            self.db.execute(
+                    "UPDATE folders SET path = ? || substr(path, ?) WHERE substr(path, 1, ?) = ?",
+                    (path + "/", len(prefix)+1, len(prefix), prefix)
+                )
+
+    @locked
+    def remove_folder(self, folder_id: str):
+        folder = self.get_folder(folder_id)
+        if folder is None:
+            return
+        prefix = folder.path + "/"
+        subtree = "SELECT id FROM folders WHERE id = ? OR substr(path, 1, ?) = ?"
+        params = (folder_id, len(prefix), prefix)
+        self.db.execute("DELETE FROM keys WHERE parent_id IN ({})".format(subtree), params)
+        self.db.execute("DELETE FROM folders WHERE id IN ({})".format(subtree), params)
+
+    @locked
+    def replace(self, keys: Iterable[IndexEntry], folders: Iterable[FolderEntry]):
+        with self.transaction():
+            self.db.execute("DELETE FROM keys")
+            self.db.execute("DELETE FROM folders")
+            self.add_many(keys)
+            self.db.executemany("INSERT OR REPLACE INTO folders (id, parent_id, name, path) VALUES (?, ?, ?, ?)", folders)
+
+    @locked
+    def add_misplaced(self, key: str, file_id: str, parent_id: str, target_path: str = None):
+        self.db.execute(
+                    "INSERT OR REPLACE INTO misplaced (key, file_id, parent_id, target_path) VALUES (?, ?, ?, ?)",
+                    (key, file_id, parent_id, target_path)
+                )
+
+    @locked
+    def misplaced(self) -> list:
+        rows = self.db.execute("SELECT key, file_id, parent_id, target_path FROM misplaced").fetchall()
+        return [MisplacedEntry(*row) for row in rows]
+
+    def claim_misplaced(self) -> list:
+        # Takes all entries off the journal, so that no other process
+        # migrates the same keys. Whatever couldn't be migrated has to be
+        # added back.
+        with self.transaction():
+            entries = self.misplaced()
+            self.db.execute("DELETE FROM misplaced")
+        return entries
+
+    @locked
+    def remove_misplaced(self, key: str):
+        self.db.execute("DELETE FROM misplaced WHERE key = ?", (key,))
+
+    @locked
+    def get_state(self, name: str) -> str:
+        row = self.db.execute("SELECT value FROM state WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    @locked
+    def set_state(self, name: str, value: str):
+        if value is None:
+            self.db.execute("DELETE FROM state WHERE name = ?", (name,))
+        else:
+            self.db.execute("INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)", (name, value))
+
+    @property
+    def page_token(self) -> str:
+        # Set only while the index mirrors the complete remote tree
+        return self.get_state("page_token")
+
+    @page_token.setter
+    def page_token(self, page_token: str):
+        self.set_state("page_token", page_token)
+
+    @locked
+    def close(self):
+        self.db.close()
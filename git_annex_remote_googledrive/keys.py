@@ -14,6 +14,7 @@ from pathlib import PurePath
 from os import PathLike
 import abc
 import itertools
+import threading
 import uuid
 from typing import Union
 
@@ -31,26 +32,55 @@ from annexremote import RemoteError
 
 from googleapiclient.errors import HttpError
 
+from .index import KeyIndex, IndexEntry
+from .listing import TreeListing, ChangesFeed
+from .migration import BatchMover, Move
+from .lookup import LookupCoalescer
+from .transfer import ThroughputStats, ResumableUpload, ChunkedDownload, ContentMismatchError
+from .transfer import LocalContentMismatchError
+from .transfer import MultipartUpload, DEFAULT_BUFFER_SIZE, MULTIPART_MAX_SIZE
+from .backends import key_digest, md5_from_key, hash_file
+from .transport import share_connections, ConnectionPool
+
+import os
+import sqlite3
 import logging
 
+# Process-wide cache of the path of folders relative to a root folder, by
+# root ID and folder ID. None means the folder is not below the root.
+_ancestry = dict()
+
 class NotAFileError(Exception):
     pass
 
 class HasSubdirError(Exception):
     pass
 
+class StaleFolderError(FileNotFoundError):
+    pass
+
 class RemoteRootBase(abc.ABC):
     def __init__(self, rootfolder: DriveFolder, annex: Annex, uuid: str=None, local_appdir: Union(str, PathLike)=None):
         self.creator = None
         self.annex = annex
         self.folder = rootfolder
         self.uuid = uuid
+        self.index = None
+        self._folders = dict()
+        self._lock = threading.RLock()
         if local_appdir is not None:
             self.local_appdir = Path(local_appdir)
+            if uuid is not None:
+                self.index = KeyIndex(self.local_appdir / uuid / "index.sqlite3")
+        self.throughput = ThroughputStats(self.index)
+
+    def connection_stats(self) -> str:
+        http = self.folder.drive.service._http
+        return http.stats() if isinstance(http, ConnectionPool) else None
 
     @classmethod
     def from_path(cls, creds_json, rootpath, *args, **kwargs) -> cls:
-        drive = GoogleDrive(creds_json)
+        drive = share_connections(GoogleDrive(creds_json))
         root = drive.create_path(rootpath)
         new_obj = cls(root, *args, **kwargs)
         new_obj.creator = "from_path"
@@ -58,7 +88,7 @@ class RemoteRootBase(abc.ABC):
 
     @classmethod
     def from_id(cls, creds_json, root_id, *args, **kwargs) -> cls:
-        drive = GoogleDrive(creds_json)
+        drive = share_connections(GoogleDrive(creds_json))
         root = drive.item_by_id(root_id)
         if root.isfolder():
             new_obj = cls(root, *args, **kwargs)
@@ -77,9 +107,135 @@ class RemoteRootBase(abc.ABC):
     def creds(self) -> Credentials:
         return self.folder.drive.creds
 
+    def _update_index(self, key: str, remote_file: DriveFile, size: int = None, md5: str = None):
+        if self.index is not None and remote_file.id:
+            self.index.add(key, remote_file.id, next(iter(remote_file.parent_ids), None), size=size, md5=md5)
+
+    def find_content(self, key: str, local_filename: str) -> DriveFile:
+        # Looks for a file with the same content as local_filename among the
+        # files known to the indexes of this repository's remotes. Returns
+        # None if there is none, or it can't be confirmed to be the same.
+        size = os.path.getsize(local_filename)
+        md5 = md5_from_key(key)
+        local_md5 = md5
+        for index in self._content_indexes():
+            for entry in index.find_content(key, size, md5):
+                remote_file = DriveFile(self.folder.drive, [entry.parent_id], entry.key, entry.file_id)
+                try:
+                    meta = remote_file.meta_get("size, md5Checksum, trashed")
+                except (FileNotFoundError, HttpError):
+                    continue
+                if meta.get('trashed') or 'md5Checksum' not in meta or int(meta.get('size', -1)) != size:
+                    continue
+                if local_md5 is None:
+                    local_md5 = hash_file(local_filename)
+                if meta['md5Checksum'] == local_md5:
+                    return remote_file
+        return None
+
+    def _content_indexes(self) -> list:
+        # The indexes of the other remotes of this repository. They may be in
+        # a different Drive, in which case their files can't be found.
+        if not hasattr(self, '_other_indexes'):
+            self._other_indexes = list()
+            if getattr(self, 'local_appdir', None) is not None:
+                for db_file in sorted(self.local_appdir.glob("*/index.sqlite3")):
+                    if db_file.parent.name != self.uuid:
+                        try:
+                            self._other_indexes.append(KeyIndex(db_file))
+                        except sqlite3.Error as e:
+                            logging.debug("Can't open %s: %s", db_file, e)
+        return self._other_indexes
+
+    def _create_path(self, path: str) -> DriveFolder:
+        # Layout folders rarely change, so their IDs are cached across
+        # processes. If a cached folder turns out to be gone, Key.upload
+        # raises StaleFolderError and the folder is created again.
+        path = path.strip("/")
+        if path in ("", "."):
+            return self.folder
+        folder = self._cached_folder(path)
+        if folder is None:
+            # Parallel stores must not create the same folder twice
+            with self._lock:
+                folder = self._cached_folder(path)
+                if folder is None:
+                    folder = self.folder.create_path(path)
+                    self._cache_folder(path, folder)
+        return folder
+
+    def _find_path(self, path: str) -> DriveFolder:
+        # Like _create_path, but never creates anything. Returns None if
+        # the folder doesn't exist.
+        path = path.strip("/")
+        if path in ("", "."):
+            return self.folder
+        folder = self._cached_folder(path)
+        if folder is None:
+            try:
+                folder = self.folder.child_from_path(path)
+            except FileNotFoundError:
+                return None
+            if not folder.isfolder():
+                return None
+            self._cache_folder(path, folder)
+        return folder
+
+    def _cached_folder(self, path: str) -> DriveFolder:
+        folder = self._folders.get(path)
+        if folder is None and self.index is not None:
+            entry = self.index.get_folder_by_path(path)
+            if entry is not None:
+                folder = DriveFolder(self.folder.drive, [entry.parent_id], entry.name, entry.id, 'drive')
+                self._folders[path] = folder
+        return folder
+
+    def _cache_folder(self, path: str, folder: DriveFolder):
+        self._folders[path] = folder
+        if self.index is not None:
+            self.index.add_folder(folder.id, next(iter(folder.parent_ids), None), folder.name, path)
+
+    def forget_folder(self, folder_id: str) -> bool:
+        cached = False
+        paths = [path for path, folder in self._folders.items() if folder.id == folder_id]
+        for path in list(self._folders.keys()):
+            if any(path == p or path.startswith(p+"/") for p in paths):
+                del self._folders[path]
+                cached = True
+        if self.index is not None and self.index.get_folder(folder_id) is not None:
+            self.index.remove_folder(folder_id)
+            cached = True
+        _ancestry.get(self.folder.id, dict()).pop(folder_id, None)
+        if cached:
+            self.annex.debug("Cached folder {} is gone".format(folder_id))
+        return cached
+
 class RemoteRoot(RemoteRootBase):
     def __init__(self, rootfolder: DriveFolder, annex: Annex, uuid: str=None, local_appdir: Union(str, PathLike)=None):
         super().__init__(rootfolder, annex, uuid=uuid, local_appdir=local_appdir)
+        self.key_map = None
+        self.index_synced = False
+        self.lookups = LookupCoalescer(rootfolder.drive, concurrent=getattr(annex, 'async_enabled', False))
+
+    def load_listing(self):
+        listing = TreeListing(self.folder).run()
+        self.key_map = listing.keys
+        self._folders.update(listing.folders)
+        ancestry = _ancestry.setdefault(self.folder.id, dict())
+        for path, folder in listing.folders.items():
+            ancestry[folder.id] = path
+        self.annex.debug("Listed {} keys in {} folders".format(len(listing.keys), len(listing.folders)))
+
+    def sync_index(self):
+        if self.index is None:
+            self.load_listing()
+            return
+        ChangesFeed(self.folder, self.index).sync()
+        self.index_synced = True
+        for entry in self.index.folders():
+            if entry.path:
+                self._folders[entry.path] = DriveFolder(self.folder.drive, [entry.parent_id], entry.name, entry.id, 'drive')
+        self.annex.debug("Key index is up to date")
 
     def get_key(self, key: str) -> Key:
         try:
@@ -98,6 +254,16 @@ class RemoteRoot(RemoteRootBase):
             raise NotAFileError(key)
         return Key(self, key, remote_file)
 
+    def has_key(self, key: str) -> bool:
+        # Presence check that only reads. Keys which are stored in the wrong
+        # place are recorded to be migrated later instead of moving them now.
+        try:
+            remote_file = self._find_remote_file(key)
+        except FileNotFoundError:
+            return False
+        self._check_placement(key, remote_file)
+        return True
+
     def new_key(self, key: str) -> Key:
         try:
             remote_file = self._new_remote_file(key)
@@ -110,18 +276,164 @@ class RemoteRoot(RemoteRootBase):
             self.get_key(key).file.remove()
         except FileNotFoundError:
             pass
+        if self.index is not None:
+            self.index.remove(key)
+            self.index.remove_misplaced(key)
+        if self.key_map is not None:
+            self.key_map.pop(key, None)
     
     def _lookup_remote_file(self, key: str) -> DriveFile:
-        remote_file = self._find_elsewhere(key)
-        parent = self._lookup_parent(key)
-        if remote_file.parent != parent:
-            self._migrate_remote_file(remote_file, parent)
+        remote_file = self._find_remote_file(key)
+        self._check_placement(key, remote_file)
+        self._update_index(key, remote_file)
         return remote_file
 
-    def _migrate_remote_file(self, remote_file: DriveFile, new_parent: DriveFolder):
-        original_parent = remote_file.parent
-        remote_file.move(new_parent)
-        self._trash_empty_parents(original_parent)
+    def _check_placement(self, key: str, remote_file: DriveFile):
+        # Moving keys to where the layout expects them is left to
+        # migrate_misplaced, so lookups don't have to pay for it.
+        if self.index is not None and self._is_misplaced(key, remote_file):
+            self.annex.debug("{} is not stored according to the current layout".format(key))
+            self.index.add_misplaced(key, remote_file.id, next(iter(remote_file.parent_ids), None), self._expected_path(key))
+
+    def _is_misplaced(self, key: str, remote_file: DriveFile) -> bool:
+        return self._folder_path(next(iter(remote_file.parent_ids), None)) != self._expected_path(key)
+
+    @abc.abstractmethod
+    def _expected_path(self, key: str) -> str:
+        raise NotImplementedError
+
+    def migrate_misplaced(self):
+        if self.index is None:
+            return
+        entries = self.index.claim_misplaced()
+        # Keys that are where they belong or gone, and don't need to be
+        # recorded again
+        resolved = set()
+        moved = list()
+        try:
+            moves = self._plan_moves(entries, resolved)
+            if moves:
+                logging.info("Migrating %d keys to the current layout", len(moves))
+                moved = BatchMover(self.folder.drive).run(moves)
+        finally:
+            # Whatever hasn't been moved is put back, even if something
+            # went wrong on the way
+            resolved.update(move.key for move in moved)
+            with self.index.transaction():
+                for move in moved:
+                    self.index.set_parent(move.file_id, move.new_parent_id)
+                for entry in entries:
+                    if entry.key not in resolved:
+                        self._unclaim(entry)
+        if not moved:
+            return
+        if self.key_map is not None:
+            for move in moved:
+                if move.key in self.key_map:
+                    self.key_map[move.key] = self.key_map[move.key]._replace(parent_id=move.new_parent_id)
+
+        # Deepest folders first, so their parents are empty by the time
+        # they are checked
+        old_parents = {move.old_parent_id for move in moved}
+        paths = {folder_id: self._folder_path(folder_id) for folder_id in old_parents}
+        for folder_id in sorted(old_parents, key=lambda f: -(paths[f] or "").count("/")):
+            if paths[folder_id]:
+                self._trash_empty_parents(self.folder.drive.item_by_id(folder_id))
+
+    def _plan_moves(self, entries: list, resolved: set) -> list:
+        moves = list()
+        targets = dict()
+        for entry in entries:
+            if entry.target_path is None:
+                new_parent = self._lookup_parent(entry.key)
+            else:
+                if entry.target_path not in targets:
+                    targets[entry.target_path] = self._existing_path(entry.target_path)
+                new_parent = targets[entry.target_path]
+            if new_parent is None:
+                continue
+            parent_id = entry.parent_id
+            if parent_id is None:
+                # Moving needs the current parent, or the file would end up
+                # in both folders
+                try:
+                    parent_id = next(iter(self.folder.drive.item_by_id(entry.file_id).parent_ids), None)
+                except FileNotFoundError:
+                    resolved.add(entry.key)
+                    continue
+                if parent_id is None:
+                    logging.warning("Not moving %s: it has no parent", entry.key)
+                    resolved.add(entry.key)
+                    continue
+            if new_parent.id == parent_id:
+                resolved.add(entry.key)
+            else:
+                moves.append(Move(entry.key, entry.file_id, parent_id, new_parent.id))
+        return moves
+
+    def _existing_path(self, path: str) -> DriveFolder:
+        # Like _create_path, but makes sure that a cached folder still
+        # exists, so that nothing is moved into a folder that is gone
+        folder = self._create_path(path)
+        if folder == self.folder:
+            return folder
+        try:
+            gone = folder.meta_get("trashed")['trashed']
+        except FileNotFoundError:
+            gone = True
+        if gone:
+            self.forget_folder(folder.id)
+            folder = self._create_path(path)
+        return folder
+
+    def _unclaim(self, entry):
+        self.index.add_misplaced(entry.key, entry.file_id, entry.parent_id, entry.target_path)
+
+    def _find_remote_file(self, key: str) -> DriveFile:
+        if self.key_map is not None:
+            entry = self.key_map.get(key)
+        elif self.index_synced:
+            entry = self.index.get(key)
+        else:
+            remote_file = self._find_indexed(key)
+            if remote_file is None:
+                remote_file = self._find_elsewhere(key)
+            return remote_file
+
+        # Both the listing and the synced index cover the whole tree, so a
+        # miss is final
+        if entry is None:
+            raise FileNotFoundError(key)
+        return DriveFile(self.folder.drive, [entry.parent_id], key, entry.file_id)
+
+    def _update_index(self, key: str, remote_file: DriveFile, size: int = None, md5: str = None):
+        super()._update_index(key, remote_file, size=size, md5=md5)
+        if self.key_map is not None and remote_file.id:
+            self.key_map[key] = IndexEntry(key, remote_file.id, next(iter(remote_file.parent_ids), None), size, md5)
+
+    def _find_indexed(self, key: str) -> DriveFile:
+        if self.index is None:
+            return None
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+
+        # A single metadata request is enough to tell whether the indexed file
+        # is still there, which is much cheaper than a Drive-wide query.
+        remote_file = DriveFile(self.folder.drive, [entry.parent_id], key, entry.file_id)
+        try:
+            meta = remote_file.meta_get("name, parents, trashed")
+        except FileNotFoundError:
+            meta = None
+        if meta is None or meta['trashed'] or meta['name'] != key \
+                or entry.parent_id not in meta.get('parents', []) \
+                or not self._below_root(entry.parent_id):
+            self.annex.debug("Index entry for {} is stale. Looking it up.".format(key))
+            self.index.remove(key)
+            return None
+
+        remote_file.parent_ids = meta['parents']
+        return remote_file
 
     @abc.abstractmethod
     def _lookup_parent(self, key: str) -> DriveFolder:
@@ -138,27 +450,65 @@ class RemoteRoot(RemoteRootBase):
         raise RemoteError(error_message)
 
     def _is_descendant_of_root(self, f: DriveFile) -> bool:
-        path = ""
-        for p in f.parents:
-            path = "/".join((p.name,path))
-            if p == self.folder:
-                self.annex.debug("Found key in {}".format(path))
-                return True
-        return False
+        path = self._folder_path(next(iter(f.parent_ids), None))
+        if path is None:
+            return False
+        self.annex.debug("Found key in {}/{}".format(self.folder.name, path))
+        return True
+
+    def _below_root(self, folder_id: str) -> bool:
+        # The folder may have left the root since the key was indexed
+        try:
+            return self._folder_path(folder_id) is not None
+        except FileNotFoundError:
+            self.forget_folder(folder_id)
+            return False
+
+    def _folder_path(self, folder_id: str) -> str:
+        # Returns the path of the folder relative to the root or None if it
+        # isn't below the root. Every folder resolved on the way is memoized,
+        # so folders sharing ancestors only need the missing part resolved.
+        # Folders recorded in the index are only trusted while the changes
+        # feed keeps it up to date. Otherwise, they may have been moved or
+        # deleted since.
+        ancestry = _ancestry.setdefault(self.folder.id, dict())
+        visited = []
+        path = None
+        while folder_id is not None:
+            if folder_id == self.folder.id:
+                path = ""
+                break
+            if folder_id in ancestry:
+                path = ancestry[folder_id]
+                break
+            if self.index is not None and self.index_synced:
+                entry = self.index.get_folder(folder_id)
+                if entry is not None:
+                    path = ancestry[folder_id] = entry.path
+                    break
+            folder = self.folder.drive.item_by_id(folder_id)
+            visited.append(folder)
+            folder_id = next(iter(folder.parent_ids), None)
+
+        for folder in reversed(visited):
+            if path is not None:
+                path = "/".join((path, folder.name)).lstrip("/")
+                if self.index is not None:
+                    self.index.add_folder(folder.id, next(iter(folder.parent_ids), None), folder.name, path)
+            ancestry[folder.id] = path
+        return path
 
     def _trash_empty_parents(self, parent: DriveFolder):
         for p in itertools.chain([parent], parent.parents):
-            if p.isempty():
-                self.annex.debug("Trashing empty folder {}".format(p.name))
-                p.trash()
-            else:
+            if p == self.folder or not p.isempty():
                 break
+            logging.debug("Trashing empty folder %s", p.name)
+            p.trash()
+            self.forget_folder(p.id)
 
     def _find_elsewhere(self, key: str) -> DriveFile:
-        query = "name='{}'".format(key)
-        query += " and mimeType != 'application/vnd.google-apps.folder'"
-        query += " and trashed = false"
-        files = self.folder.drive.items_by_query(query)
+        # Concurrent jobs share a single query
+        files = self.lookups.lookup(key)
 
         for f in files:
             if self._is_descendant_of_root(f):
@@ -222,6 +572,9 @@ class NodirRemoteRoot(RemoteRoot):
     def _lookup_parent(self, key):
         return self.folder
 
+    def _expected_path(self, key: str) -> str:
+        return ""
+
     def handle_full_folder(self, key=None):
         error_message = "Remote root folder {} is full (max. 500.000 files exceeded)." \
                             " Please switch to a different layout and consult"\
@@ -230,25 +583,26 @@ class NodirRemoteRoot(RemoteRoot):
 
 class LowerRemoteRoot(RemoteRoot):
     def _lookup_parent(self, key: str) -> DriveFolder:
-        path = self.annex.dirhash_lower(key)
-        return self.folder.create_path(path)
+        return self._create_path(self._expected_path(key))
 
-    def _migrate_remote_file(self, remote_file: DriveFile, new_parent: DriveFolder):
-        original_parent = remote_file.parent
-        # file will be replacing its own parent if migrating from directory layout
-        remote_file.move(new_parent, ignore_existing=(remote_file.name == remote_file.parent.name)) 
-        self._trash_empty_parents(original_parent)
+    def _expected_path(self, key: str) -> str:
+        return self.annex.dirhash_lower(key).strip("/")
 
 class DirectoryRemoteRoot(RemoteRoot):
     def _lookup_parent(self, key: str) -> DriveFolder:
         path = '/'.join((self.annex.dirhash_lower(key), key))
         # FIXME: fails if migrating from lower layout
         return self.folder.create_path(path)
+
+    def _expected_path(self, key: str) -> str:
+        return '/'.join((self.annex.dirhash_lower(key).strip("/"), key))
         
 class MixedRemoteRoot(RemoteRoot):
     def _lookup_parent(self, key: str) -> DriveFolder:
-        path = self.annex.dirhash(key)
-        return self.folder.create_path(path)
+        return self._create_path(self._expected_path(key))
+
+    def _expected_path(self, key: str) -> str:
+        return self.annex.dirhash(key).strip("/")
 
 class NestedRemoteRoot(RemoteRoot):
     def __init__(self, rootfolder: DriveFolder, annex: Annex, uuid: str=None, local_appdir: Union(str, PathLike)=None):
@@ -260,10 +614,22 @@ class NestedRemoteRoot(RemoteRoot):
     def _lookup_parent(self, key: str) -> DriveFolder:
         return self.current_folder
 
+    def _expected_path(self, key: str) -> str:
+        # Keys can be in any nested folder. New ones go to the current one.
+        return None
+
+    def _is_misplaced(self, key: str, remote_file: DriveFile) -> bool:
+        path = self._folder_path(next(iter(remote_file.parent_ids), None))
+        if not path:
+            return True
+        return not all(p.startswith(self.nested_prefix) for p in path.split("/"))
+
     @property
     def current_folder(self):
         if not hasattr(self, "_current_folder"):
-            self._current_folder = self.next_subfolder()
+            with self._lock:
+                if not hasattr(self, "_current_folder"):
+                    self._current_folder = self.next_subfolder()
         return self._current_folder
 
     @current_folder.setter
@@ -271,9 +637,10 @@ class NestedRemoteRoot(RemoteRoot):
         self._current_folder = new_target
 
     def next_subfolder(self):
-        if not hasattr(self, "_subfolders"):
-            self._subfolders = self._sub_generator(self.folder)
-        return next(self._subfolders, None)
+        with self._lock:
+            if not hasattr(self, "_subfolders"):
+                self._subfolders = self._sub_generator(self.folder)
+            return next(self._subfolders, None)
 
     def _sub_generator(self, parent_folder=None):
         parent_folder = parent_folder or self.folder
@@ -337,32 +704,98 @@ class Key():
         self.file = remote_file
         self._resumable_uri = None
 
-    def upload(self, local_filename: str, chunksize: int = None, progress_handler: callable = None):
-
+    def upload(self, local_filename: str, chunksize: int = None, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                    progress_handler: callable = None):
+        if self.file.id is None and self._copy_existing(local_filename, progress_handler):
+            return
+        try:
+            if os.path.getsize(local_filename) <= MULTIPART_MAX_SIZE:
+                upload = self._upload_multipart(local_filename, progress_handler)
+            else:
+                upload = self._upload_resumable(local_filename, chunksize, buffer_size, progress_handler)
+        except FileExistsError:
+            # Uploading an existing key is not an error
+            return
+        except LocalContentMismatchError as e:
+            raise RemoteError("Content of {} does not match key {}: {}".format(local_filename, self.key, e)) from e
+        self.root._update_index(self.key, self.file, size=upload.total_size, md5=upload.md5sum)
+
+    def _copy_existing(self, local_filename: str, progress_handler: callable = None) -> bool:
+        # If the content is already on Drive, a server-side copy saves
+        # sending it again
+        source = self.root.find_content(self.key, local_filename)
+        if source is None:
+            return False
+        try:
+            result = self.file.drive.service.files().copy(
+                                fileId=source.id,
+                                body={'name': self.file.name, 'parents': list(self.file.parent_ids)},
+                                fields="id, name, size, md5Checksum"
+                            ).execute()
+        except HttpError as e:
+            logging.warning("Copying %s failed, uploading it instead: %s", source.id, e)
+            return False
+        self.file.id = result['id']
+        self.file.name = result['name']
+        self.root.annex.debug("Copied {} from existing file {}".format(self.key, source.id))
+        self.root._update_index(self.key, self.file, size=int(result['size']), md5=result['md5Checksum'])
+        if progress_handler:
+            progress_handler(int(result['size']))
+        return True
+
+    def _upload_multipart(self, local_filename: str, progress_handler: callable = None) -> MultipartUpload:
+        # Small files don't need a session, so there's no resumable_uri to keep
+        upload = MultipartUpload(self.file, local_filename, md5sum=md5_from_key(self.key))
         try:
-            self.file.upload(local_filename,
+            try:
+                upload.run()
+            except LocalContentMismatchError:
+                raise
+            except CheckSumError:
+                logging.warning("Checksum mismatch. Repeating upload")
+                upload.run()
+        except FileNotFoundError as e:
+            if self.root.forget_folder(next(iter(self.file.parent_ids), None)):
+                raise StaleFolderError(self.key) from e
+            raise
+        if progress_handler:
+            progress_handler(upload.total_size)
+        return upload
+
+    def _upload_resumable(self, local_filename: str, chunksize: int = None, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                    progress_handler: callable = None) -> ResumableUpload:
+        try:
+            upload = ResumableUpload(self.file, local_filename, self.root.throughput,
                              chunksize=chunksize,
                              resumable_uri=self.resumable_uri,
+                             md5sum=md5_from_key(self.key),
+                             buffer_size=buffer_size,
                              progress_handler=self._upload_progress(progress_handler)
                             )
-        except (CheckSumError, HttpError) as e:
+            upload.run()
+        except LocalContentMismatchError:
+            raise
+        except (CheckSumError, HttpError, FileNotFoundError) as e:
             if isinstance(e, CheckSumError):
                 logging.warning("Checksum mismatch. Repeating upload")
-            elif isinstance(e, HttpError) and e.resp['status'] == '404':
+            elif self.resumable_uri and (isinstance(e, FileNotFoundError) or e.resp['status'] == '404'):
                 logging.warning("Invalid resumable_uri. Probably expired. Repeating upload.")
+            elif isinstance(e, FileNotFoundError) and self.root.forget_folder(next(iter(self.file.parent_ids), None)):
+                raise StaleFolderError(self.key) from e
             else:
                 raise
             
             self.resumable_uri = None
-            self.file.upload(local_filename,
+            upload = ResumableUpload(self.file, local_filename, self.root.throughput,
                              chunksize=chunksize,
+                             md5sum=md5_from_key(self.key),
+                             buffer_size=buffer_size,
                              progress_handler=self._upload_progress(progress_handler)
                             )
-        except FileExistsError:
-            # Uploading an existing key is not an error
-            return
+            upload.run()
 
         self.resumable_uri = None
+        return upload
 
     @property
     def resumable_uri(self) -> str:
@@ -401,9 +834,37 @@ class Key():
                 progress_handler(progress.resumable_progress)
         return fun
 
-    def download(self, local_filename: str, chunksize: int = None, progress_handler: callable = None):
+    def download(self, local_filename: str, chunksize: int = None, connections: int = 1,
+                    buffer_size: int = DEFAULT_BUFFER_SIZE, progress_handler: callable = None):
         self.progress_handler = progress_handler
-        self.file.download(local_filename, chunksize=chunksize, progress_handler=self._download_progress)
+        download = ChunkedDownload(self.file, local_filename, self.root.throughput,
+                            chunksize=chunksize,
+                            connections=connections,
+                            buffer_size=buffer_size,
+                            state_file=self.download_state_file,
+                            digest=key_digest(self.key),
+                            progress_handler=self._download_progress
+                        )
+        try:
+            download.run()
+        except ContentMismatchError:
+            raise
+        except CheckSumError:
+            logging.warning("Checksum mismatch. Repeating download")
+            download.run()
+
+    def has_content(self, local_filename: str) -> bool:
+        meta = self.file.meta_get("size, md5Checksum")
+        if 'md5Checksum' not in meta or int(meta.get('size', -1)) != os.path.getsize(local_filename):
+            return False
+        md5 = md5_from_key(self.key) or hash_file(local_filename)
+        return meta['md5Checksum'] == md5
+
+    @property
+    def download_state_file(self) -> Path:
+        if self.root.local_appdir and self.root.uuid:
+            return self.root.local_appdir / self.root.uuid / "resume-download" / self.key
+        return None
 
     def _download_progress(self, progress: MediaDownloadProgress):
         if self.progress_handler:
@@ -419,16 +880,57 @@ class ExportRemoteRoot(RemoteRootBase):
             raise NotAFileError(str(remote_path))
         return ExportKey(self, key, remote_path, remote_file)
 
-    def new_key(self, key: str, remote_path: Union(str, PathLike)) -> ExportKey:
+    def has_key(self, key: str, remote_path: Union(str, PathLike)) -> bool:
+        remote_path = PurePath(remote_path)
+        parent_path = str(remote_path.parent).strip("/")
+        # A miss in a cached folder may only mean that the folder is gone
+        # or has been replaced, so the path is resolved once more without
+        # the cache
+        cached = parent_path not in ("", ".") and self._cached_folder(parent_path) is not None
+        while True:
+            parent = self._find_path(parent_path)
+            if parent is None:
+                return False
+            try:
+                remote_file = parent.child(remote_path.name)
+            except FileNotFoundError:
+                if cached and self.forget_folder(parent.id):
+                    cached = False
+                    continue
+                return False
+            except AmbiguousPathError:
+                return True
+            return not remote_file.isfolder()
+
+    def new_key(self, key: str, remote_path: Union(str, PathLike), local_filename: str = None) -> ExportKey:
+        # If the file already exists with the same content, it is returned
+        # as is, so uploading it is a no-op. Different content is replaced
+        # once the upload has succeeded.
         remote_path = PurePath(remote_path)
+        replaces = None
         try:
-            self.get_key(key, str(remote_path))
+            existing = self.get_key(key, str(remote_path))
         except FileNotFoundError:
-            parent = self.folder.create_path(str(remote_path.parent))
-            remote_file = parent.new_file(remote_path.name)
-            return ExportKey(self, key, remote_path, remote_file)
+            pass
         else:
-            raise FileExistsError(remote_path)
+            if local_filename is None:
+                raise FileExistsError(remote_path)
+            if existing.has_content(local_filename):
+                self.annex.debug("{} is unchanged. Skipping upload.".format(remote_path))
+                return existing
+            replaces = existing.file
+
+        parent = self._create_path(str(remote_path.parent))
+        # The file it replaces is still there
+        remote_file = parent.new_file(remote_path.name, ignore_existing=replaces is not None)
+        return ExportKey(self, key, remote_path, remote_file, replaces=replaces)
+
+    def _content_indexes(self) -> list:
+        # The same key may already be exported to another path
+        indexes = super()._content_indexes()
+        if self.index is not None:
+            return [self.index] + indexes
+        return indexes
             
     def delete_key(self, key:str, remote_path: Union(str, PathLike)):
         try:
@@ -441,8 +943,14 @@ class ExportRemoteRoot(RemoteRootBase):
         new_remote_path = PurePath(new_remote_path)
 
         remote_file = self.get_key(key, remote_path).file
-        new_parent = self.folder.create_path(str(new_remote_path.parent))
-        remote_file.move(new_parent, new_name=new_remote_path.name)
+        new_parent = self._create_path(str(new_remote_path.parent))
+        try:
+            remote_file.move(new_parent, new_name=new_remote_path.name)
+        except FileNotFoundError:
+            if not self.forget_folder(new_parent.id):
+                raise
+            new_parent = self._create_path(str(new_remote_path.parent))
+            remote_file.move(new_parent, new_name=new_remote_path.name)
 
     def delete_dir(self, dir_path: Union(str, PathLike)):
         try:
@@ -452,8 +960,25 @@ class ExportRemoteRoot(RemoteRootBase):
         if not remote_folder.isfolder():
             raise NotADirectoryError
         remote_folder.remove()
+        self.forget_folder(remote_folder.id)
 
 class ExportKey(Key):
-    def __init__(self, root: ExportRemoteRoot, key: str, path: Union(str, PathLike), remote_file: DriveFile):
+    # replaces is the file previously exported to the same path. It is
+    # removed after the upload, so a failed upload doesn't lose it.
+    def __init__(self, root: ExportRemoteRoot, key: str, path: Union(str, PathLike), remote_file: DriveFile,
+                    replaces: DriveFile = None):
         super().__init__(root, key, remote_file)
         self.path = PurePath(path)
+        self.replaces = replaces
+
+    def upload(self, *args, **kwargs):
+        super().upload(*args, **kwargs)
+        if self.replaces is None or self.replaces.id == self.file.id:
+            return
+        try:
+            self.replaces.remove()
+        except FileNotFoundError:
+            pass
+        if self.root.index is not None:
+            self.root.index.remove_file(self.replaces.id)
+        self.replaces = None
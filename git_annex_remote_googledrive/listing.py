@@ -0,0 +1,216 @@
+# Copyright (C) 2017-2020  Silvio Ankermann
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of version 3 of the GNU
+# General Public License as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+
+from __future__ import annotations #only > 3.7, better to find a different solution
+
+from typing import Iterable
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from drivelib import DriveFolder
+from drivelib.errors import GoogleDriveAPIError
+
+from googleapiclient.errors import HttpError
+
+from .index import KeyIndex, IndexEntry, FolderEntry
+
+import logging
+
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+LISTING_FIELDS = "nextPageToken, files(id, name, mimeType, parents, size, md5Checksum)"
+CHANGES_FIELDS = "nextPageToken, newStartPageToken," \
+                 " changes(fileId, removed, file(id, name, mimeType, parents, trashed, size, md5Checksum))"
+MAX_PAGE_SIZE = 1000
+DEFAULT_WORKERS = 8
+# Replies to a page token Drive doesn't know (anymore)
+INVALID_TOKEN_STATUS = (400, 404, 410)
+
+class InvalidPageTokenError(Exception):
+    pass
+
+class TreeListing():
+    # Lists everything below a folder in as few requests as possible. Folders
+    # are listed in parallel, each one with as many pages as needed.
+    def __init__(self, root_folder: DriveFolder, workers: int = DEFAULT_WORKERS):
+        self.root_folder = root_folder
+        self.drive = root_folder.drive
+        self.workers = workers
+        self.keys = dict()
+        self.folders = {"": root_folder}
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+    def run(self) -> TreeListing:
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {executor.submit(self._list_folder, self.root_folder.id): ""}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    for item in future.result():
+                        if item['mimeType'] == FOLDER_MIMETYPE:
+                            subpath = "/".join((path, item['name'])).lstrip("/")
+                            self.folders[subpath] = DriveFolder(self.drive, item.get('parents', []), item['name'], item['id'], 'drive')
+                            pending[executor.submit(self._list_folder, item['id'])] = subpath
+                        elif item['name'] not in self.keys:
+                            self.keys[item['name']] = entry_from_reply(item)
+
+        logging.info("Listed %d keys in %d folders using %d requests",
+                        len(self.keys), len(self.folders), self.request_count)
+        return self
+
+    def folder_entries(self, base_path: str = "") -> Iterable[FolderEntry]:
+        for path, folder in self.folders.items():
+            path = "/".join((base_path, path)).strip("/")
+            yield FolderEntry(folder.id, next(iter(folder.parent_ids), None), folder.name, path)
+
+    def _list_folder(self, folder_id: str) -> list:
+        query = "'{}' in parents and trashed = false".format(folder_id)
+        items = list()
+        page_token = None
+        while True:
+            request = self.drive.service.files().list(
+                            q=query,
+                            spaces='drive',
+                            pageSize=MAX_PAGE_SIZE,
+                            fields=LISTING_FIELDS,
+                            pageToken=page_token,
+                        )
+            try:
+                result = request.execute()
+            except HttpError as err:
+                raise GoogleDriveAPIError.from_http_error(err)
+            with self._lock:
+                self.request_count += 1
+            items.extend(result.get('files', []))
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                return items
+
+def entry_from_reply(item: dict) -> IndexEntry:
+    size = item.get('size')
+    return IndexEntry(
+                item['name'],
+                item['id'],
+                next(iter(item.get('parents', [])), None),
+                int(size) if size is not None else None,
+                item.get('md5Checksum'),
+            )
+
+class ChangesFeed():
+    # Keeps a KeyIndex in sync with the remote tree by applying the Drive
+    # changes that happened since the last run.
+    def __init__(self, root_folder: DriveFolder, index: KeyIndex):
+        self.root_folder = root_folder
+        self.drive = root_folder.drive
+        self.index = index
+
+    def sync(self):
+        if self.index.page_token is None \
+                or self.index.get_state("root_id") != self.root_folder.id:
+            self.relist()
+            return
+        try:
+            self.apply_changes()
+        except InvalidPageTokenError as e:
+            logging.info("Drive doesn't accept the stored page token (%s). Listing everything again.", e)
+            self.relist()
+
+    def relist(self):
+        # Get the token first, so changes made during the listing aren't lost
+        page_token = self._execute(self.drive.service.changes().getStartPageToken())['startPageToken']
+        listing = TreeListing(self.root_folder).run()
+        self.index.replace(listing.keys.values(), listing.folder_entries())
+        self.index.set_state("root_id", self.root_folder.id)
+        self.index.page_token = page_token
+        # Keys other processes added to the index while we were listing are
+        # gone with the rows replaced above. The changes since the start of
+        # the listing bring them back.
+        self.apply_changes()
+
+    def apply_changes(self):
+        page_token = self.index.page_token
+        count = 0
+        while True:
+            request = self.drive.service.changes().list(
+                                        pageToken=page_token,
+                                        pageSize=MAX_PAGE_SIZE,
+                                        spaces='drive',
+                                        includeRemoved=True,
+                                        fields=CHANGES_FIELDS,
+                                    )
+            try:
+                result = request.execute()
+            except HttpError as err:
+                if err.resp.status in INVALID_TOKEN_STATUS:
+                    raise InvalidPageTokenError(err.resp.status) from err
+                raise GoogleDriveAPIError.from_http_error(err)
+            moved_in = list()
+            with self.index.transaction():
+                for change in result.get('changes', []):
+                    moved_in.extend(self.apply_change(change))
+                    count += 1
+            # Listing happens without holding the index
+            for folder, path in moved_in:
+                self.add_tree(folder, path)
+            if 'newStartPageToken' in result:
+                self.index.page_token = result['newStartPageToken']
+                break
+            page_token = result['nextPageToken']
+            self.index.page_token = page_token
+        logging.info("Applied %d changes to the key index", count)
+
+    def add_tree(self, folder: DriveFolder, path: str):
+        listing = TreeListing(folder).run()
+        with self.index.transaction():
+            self.index.add_many(listing.keys.values())
+            for entry in listing.folder_entries(path):
+                self.index.add_folder(*entry)
+
+    def apply_change(self, change: dict) -> list:
+        # Returns the folders which have been moved into the tree, with
+        # their path. Their content has to be listed, as no changes are
+        # reported for it.
+        item_id = change['fileId']
+        if item_id == self.root_folder.id:
+            return []
+        item = change.get('file')
+        if change.get('removed') or item is None or item.get('trashed'):
+            self.index.remove_folder(item_id)
+            self.index.remove_file(item_id)
+            return []
+
+        parent = self.index.get_folder(next(iter(item.get('parents', [])), None))
+        if item['mimeType'] == FOLDER_MIMETYPE:
+            if parent is None:
+                # Moved out of the tree or never part of it
+                self.index.remove_folder(item_id)
+                return []
+            path = "/".join((parent.path, item['name'])).strip("/")
+            if self.index.get_folder(item_id) is None:
+                # A folder moved in from outside brings its content along.
+                # It is known from now on, so changes to its content
+                # further down are applied.
+                self.index.add_folder(item_id, parent.id, item['name'], path)
+                folder = DriveFolder(self.drive, item['parents'], item['name'], item_id, 'drive')
+                return [(folder, path)]
+            self.index.add_folder(item_id, parent.id, item['name'], path)
+        else:
+            # The file may have been renamed, so drop the old entry either way
+            self.index.remove_file(item_id)
+            if parent is not None:
+                entry = entry_from_reply(item)
+                self.index.add(*entry)
+        return []
+
+    def _execute(self, request) -> dict:
+        try:
+            return request.execute()
+        except HttpError as err:
+            raise GoogleDriveAPIError.from_http_error(err)
@@ -0,0 +1,116 @@
+# Copyright (C) 2017-2020  Silvio Ankermann
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of version 3 of the GNU
+# General Public License as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+
+import threading
+import time
+from concurrent.futures import Future
+
+from drivelib import GoogleDrive
+
+from .listing import FOLDER_MIMETYPE, MAX_PAGE_SIZE
+
+import logging
+
+# How long to wait for other lookups to join a query, in seconds
+DEFAULT_WINDOW = 0.01
+# The query ends up in the URL of a GET request, so it has to stay well
+# below the URL length limit even after being percent-encoded
+MAX_QUERY_LENGTH = 2000
+QUERY_SUFFIX = " and mimeType != '{}' and trashed = false".format(FOLDER_MIMETYPE)
+
+class LookupCoalescer():
+    # Searches the whole Drive for files by name. Lookups arriving within a
+    # short window are sent as a single `name='a' or name='b' ...` query and
+    # each caller gets the files matching its own name. The window is only
+    # waited for if other lookups may arrive: with concurrent callers, or
+    # while other lookups are under way.
+    def __init__(self, drive: GoogleDrive, window: float = DEFAULT_WINDOW, concurrent: bool = False):
+        self.drive = drive
+        self.window = window
+        self.concurrent = concurrent
+        self.query_count = 0
+        self._pending = dict()
+        self._flushing = False
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, name: str) -> list:
+        with self._lock:
+            future = self._pending.get(name)
+            if future is None:
+                future = self._pending[name] = Future()
+            leader = not self._flushing
+            self._flushing = True
+            self._active += 1
+            wait = self.concurrent or self._active > 1
+
+        try:
+            if leader:
+                self._lead(wait)
+            return future.result()
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def _lead(self, wait: bool):
+        # Whoever comes first collects the lookups of everybody else
+        try:
+            if wait:
+                time.sleep(self.window)
+        finally:
+            with self._lock:
+                names, self._pending = self._pending, dict()
+                self._flushing = False
+            try:
+                self._run(names)
+            finally:
+                # Nobody may be left waiting, whatever happened
+                for future in names.values():
+                    if not future.done():
+                        future.set_exception(RuntimeError("Lookup was not run"))
+
+    def _run(self, futures: dict):
+        for names in self._split(list(futures)):
+            results = {name: list() for name in names}
+            try:
+                for item in self.drive.items_by_query(self._query(names), pageSize=MAX_PAGE_SIZE):
+                    if item.name in results:
+                        results[item.name].append(item)
+            except Exception as e:
+                for name in names:
+                    futures[name].set_exception(e)
+                continue
+            with self._lock:
+                self.query_count += 1
+            for name in names:
+                futures[name].set_result(results[name])
+        logging.debug("Looked up %d names in %d queries", len(futures), self.query_count)
+
+    def _split(self, names: list) -> list:
+        chunks = list()
+        chunk = list()
+        length = len(QUERY_SUFFIX) + 2
+        for name in names:
+            term_length = len(self._term(name)) + len(" or ")
+            if chunk and length + term_length > MAX_QUERY_LENGTH:
+                chunks.append(chunk)
+                chunk = list()
+                length = len(QUERY_SUFFIX) + 2
+            chunk.append(name)
+            length += term_length
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _query(self, names: list) -> str:
+        return "(" + " or ".join(self._term(name) for name in names) + ")" + QUERY_SUFFIX
+
+    @staticmethod
+    def _term(name: str) -> str:
+        return "name='{}'".format(name.replace("\\", "\\\\").replace("'", "\\'"))
@@ -0,0 +1,63 @@
+# Copyright (C) 2017-2020  Silvio Ankermann
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of version 3 of the GNU
+# General Public License as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from drivelib import GoogleDrive
+
+import logging
+
+Move = namedtuple("Move", ["key", "file_id", "old_parent_id", "new_parent_id"])
+
+# Drive accepts up to 100 calls in a single batch request
+BATCH_SIZE = 100
+DEFAULT_WORKERS = 4
+
+class BatchMover():
+    # Moves files to new parents using batch requests, several at a time
+    def __init__(self, drive: GoogleDrive, workers: int = DEFAULT_WORKERS):
+        self.drive = drive
+        self.workers = workers
+
+    def run(self, moves: list) -> list:
+        # Without removeParents, Drive would add the new parent to the old one
+        for move in moves:
+            if move.old_parent_id is None:
+                logging.warning("Not moving %s: its current parent is unknown", move.key)
+        moves = [move for move in moves if move.old_parent_id is not None]
+        batches = [moves[i:i+BATCH_SIZE] for i in range(0, len(moves), BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = executor.map(self._run_batch, batches)
+            return [move for done in results for move in done]
+
+    def _run_batch(self, moves: list) -> list:
+        done = list()
+        def callback(request_id, response, exception):
+            move = moves[int(request_id)]
+            if exception is not None:
+                logging.warning("Could not move %s: %s", move.key, exception)
+            else:
+                done.append(move)
+
+        batch = self.drive.service.new_batch_http_request(callback=callback)
+        for i, move in enumerate(moves):
+            batch.add(self.drive.service.files().update(
+                                fileId=move.file_id,
+                                addParents=move.new_parent_id,
+                                removeParents=move.old_parent_id,
+                                fields='id, parents',
+                            ), request_id=str(i))
+        try:
+            batch.execute()
+        except Exception as e:
+            # The moves reported before are done nonetheless. The others
+            # are retried next time.
+            logging.warning("Moving %d files failed: %s", len(moves) - len(done), e)
+        return done
@@ -0,0 +1,136 @@
+# Copyright (C) 2017-2020  Silvio Ankermann
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of version 3 of the GNU
+# General Public License as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+
+import json
+import socket
+import time
+from email.utils import parsedate_to_datetime
+
+from googleapiclient.errors import HttpError
+from httplib2 import ServerNotFoundError
+
+from tenacity import Retrying
+from tenacity import retry_if_exception
+from tenacity import stop_after_attempt
+from tenacity.wait import wait_base, wait_random_exponential
+
+import logging
+
+MAX_ATTEMPTS = 5
+# Upper bound of the backoff and of any Retry-After we are willing to obey,
+# in seconds
+MAX_WAIT = 64
+
+# 403 reasons which only mean "not so fast"
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+# Reasons which won't go away by asking again any time soon
+QUOTA_REASONS = {'storageQuotaExceeded', 'dailyLimitExceeded', 'uploadLimitExceeded',
+                    'quotaExceeded', 'teamDriveFileLimitExceeded'}
+
+TRANSIENT_EXCEPTIONS = (ConnectionError, TimeoutError, socket.timeout, ServerNotFoundError)
+
+def reply_reason(content: bytes) -> str:
+    # The reason Drive gives in the body of an error reply, if any
+    return _reply_error(content, 'reason')
+
+def reply_message(content: bytes) -> str:
+    return _reply_error(content, 'message')
+
+def _reply_error(content: bytes, field: str) -> str:
+    try:
+        body = json.loads(content.decode("utf-8"))
+        return body['error']['errors'][0][field]
+    except (AttributeError, ValueError, KeyError, IndexError, TypeError):
+        return None
+
+def error_reason(error: HttpError) -> str:
+    return reply_reason(error.content)
+
+def is_rate_limit(status: int, reason: str) -> bool:
+    return status == 429 or (status == 403 and reason in RATE_LIMIT_REASONS)
+
+def classify(error: BaseException) -> str:
+    # One of 'rate-limit', 'server', 'network', 'quota', 'not-found' and
+    # 'permanent'. Only the first three are worth retrying.
+    if isinstance(error, FileNotFoundError):
+        return 'not-found'
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        reason = error_reason(error)
+        if reason in QUOTA_REASONS:
+            return 'quota'
+        if is_rate_limit(status, reason):
+            return 'rate-limit'
+        if status == 404:
+            return 'not-found'
+        if status >= 500 or status == 408:
+            return 'server'
+        return 'permanent'
+    if isinstance(error, TRANSIENT_EXCEPTIONS):
+        return 'network'
+    return 'permanent'
+
+def is_transient(error: BaseException) -> bool:
+    if getattr(error, 'retries_exhausted', False):
+        # Already retried where it happened
+        return False
+    return classify(error) in ('rate-limit', 'server', 'network')
+
+def retry_after(error: BaseException) -> float:
+    # Seconds the server asked us to wait, or None
+    resp = getattr(error, 'resp', None)
+    value = resp.get('retry-after') if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class wait_retry_after(wait_base):
+    # Exponential backoff with full jitter, unless the server said how long
+    # to wait
+    def __init__(self, multiplier: float = 1, max: float = MAX_WAIT):
+        self.backoff = wait_random_exponential(multiplier=multiplier, max=max)
+        self.max = max
+
+    def __call__(self, retry_state) -> float:
+        requested = retry_after(retry_state.outcome.exception())
+        if requested is not None:
+            return min(requested, self.max)
+        return self.backoff(retry_state)
+
+def _log_retry(retry_state):
+    error = retry_state.outcome.exception()
+    logging.info("%s (%s). Retrying in %.1fs (attempt %d of %d).",
+                    error.__class__.__name__, classify(error),
+                    retry_state.next_action.sleep, retry_state.attempt_number, MAX_ATTEMPTS)
+
+retry_conditions = {
+        'wait': wait_retry_after(),
+        'retry': retry_if_exception(is_transient),
+        'stop': stop_after_attempt(MAX_ATTEMPTS),
+        'before_sleep': _log_retry,
+        'reraise': True,
+    }
+
+def call_with_retry(f: callable, *args, **kwargs):
+    # Retries a single step of an operation where it failed. If it still
+    # fails, the error is marked so that the retry around the whole
+    # operation doesn't repeat the same attempts.
+    try:
+        return Retrying(**retry_conditions)(f, *args, **kwargs)
+    except Exception as e:
+        if is_transient(e):
+            e.retries_exhausted = True
+        raise
@@ -9,18 +9,16 @@
 
 import sys, os
 import pathlib
-import distutils.util
 
-import git
 import signal
-import argparse
 import json
 
+# GitPython, drivelib and the Google libraries take a while to import. They
+# are only needed by the subcommands, so a process started by git-annex
+# doesn't load them until it has something to do.
 
-from annexremote import Master
+from .async_master import AsyncMaster
 from annexremote import __version__ as annexremote_version
-from drivelib import __version__ as drivelib_version
-from drivelib import GoogleDrive
 from .google_remote import GoogleRemote
 from . import __version__
 from . import __name__ as MODULENAME
@@ -38,6 +36,7 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 def _get_token_path() -> os.PathLike:
+    import git
     git_repo = git.Repo(".", search_parent_directories=True)
     git_root = pathlib.Path(git_repo.git_dir)
     othertmp_dir = git_root / "annex/othertmp"
@@ -50,6 +49,9 @@ def _shutdown(signum, frame):
 
 
 def setup(token_file, gauth_file=None):
+    import distutils.util
+    import git
+    from drivelib import GoogleDrive
     token_file = pathlib.Path(token_file)
     if gauth_file is not None:
         gauth_file = pathlib.Path(gauth_file)
@@ -110,6 +112,8 @@ def main():
     signal.signal(signal.SIGTERM, _shutdown)
     signal.signal(signal.SIGINT, _shutdown)
     if len(sys.argv) > 1:
+        import argparse
+        import git
         parser = argparse.ArgumentParser()
         subparsers = parser.add_subparsers(dest='subcommand')
 
@@ -139,6 +143,7 @@ def main():
             setup(args.output, gauth_file=args.client_secret)
             return
         elif args.subcommand == 'version':
+            from drivelib import __version__ as drivelib_version
             print(MODULENAME, __version__)
             print("Using AnnexRemote", annexremote_version)
             print("Using drivelib", drivelib_version)
@@ -147,9 +152,11 @@ def main():
     output = sys.stdout
     sys.stdout = sys.stderr
 
-    master = Master(output)
-    master.LinkRemote(GoogleRemote(master))
+    master = AsyncMaster(output)
+    remote = GoogleRemote(master)
+    master.LinkRemote(remote)
     master.Listen()
+    remote.shutdown()
 
 
 if __name__ == '__main__':
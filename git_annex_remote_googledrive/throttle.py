@@ -0,0 +1,318 @@
+# Copyright (C) 2017-2020  Silvio Ankermann
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of version 3 of the GNU
+# General Public License as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+
+import os
+import json
+import time
+from datetime import datetime
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from os import PathLike
+from typing import Union
+
+try:
+    import fcntl
+except ImportError:
+    # No way to share the state, so every process keeps its own
+    fcntl = None
+
+from humanfriendly import format_size, format_timespan
+
+from .retrying import reply_reason, reply_message, is_rate_limit
+
+import logging
+
+INITIAL_REQUESTS = 8
+DEFAULT_MAX_REQUESTS = 32
+# Factor applied to the limit when Drive reports rate limiting
+DECREASE_FACTOR = 0.5
+# Rate limit errors within this many seconds after a decrease are caused by
+# requests sent before it and don't decrease the limit again
+DECREASE_INTERVAL = 1
+# Longest to wait for a slot before checking again, in seconds. Slots
+# freed by this process wake the waiters immediately.
+POLL_MAX = 0.5
+# How often a process exchanges its concurrency state with the others, in
+# seconds
+SYNC_INTERVAL = 1
+# Longest an upload waits for its byte budget before giving up, in seconds
+MAX_BUDGET_WAIT = 300
+DAY = 24*60*60
+HOUR = 60*60
+# Drive doesn't document how it refuses uploads once the daily limit of
+# 750GB is reached. In practice, it answers upload requests with a 403
+# userRateLimitExceeded carrying exactly this message, while ordinary rate
+# limiting comes with a longer one. rclone's --drive-stop-on-upload-limit
+# relies on the same. uploadLimitExceeded is accepted in case Drive starts
+# using a reason of its own.
+UPLOAD_LIMIT_MESSAGE = "User rate limit exceeded."
+UPLOAD_LIMIT_REASONS = {'uploadLimitExceeded'}
+
+class BudgetExhaustedError(Exception):
+    pass
+
+class UploadQuotaExceededError(Exception):
+    pass
+
+def is_upload_limit(resp, content: bytes) -> bool:
+    # Whether the reply to an upload request says that the daily upload
+    # limit has been reached
+    if resp is None or resp.status != 403:
+        return False
+    reason = reply_reason(content)
+    return reason in UPLOAD_LIMIT_REASONS \
+            or (reason == 'userRateLimitExceeded' and reply_message(content) == UPLOAD_LIMIT_MESSAGE)
+
+class SharedState():
+    # A small JSON document shared by the processes using the same file. It
+    # is only accessed with an exclusive lock held on the file. Without a
+    # file, or without fcntl, it is private to the process.
+    def __init__(self, state_file: Union[str, PathLike] = None):
+        self.state_file = Path(state_file) if state_file is not None and fcntl is not None else None
+        self._data = dict()
+        self._lock = threading.RLock()
+        if self.state_file is not None:
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            if self.state_file is None:
+                yield self._data
+                return
+            with self.state_file.open('a+') as fh:
+                fcntl.flock(fh, fcntl.LOCK_EX)
+                fh.seek(0)
+                try:
+                    data = json.loads(fh.read())
+                except ValueError:
+                    data = dict()
+                if not isinstance(data, dict):
+                    data = dict()
+                yield data
+                fh.seek(0)
+                fh.truncate()
+                fh.write(json.dumps(data))
+
+class ConcurrencyController():
+    # Limits the number of requests to Drive in flight at a time. The limit
+    # grows by one for every limit's worth of normal replies and is halved
+    # when Drive says we are too fast (additive increase, multiplicative
+    # decrease). The limit and the requests in flight are counted in the
+    # process and exchanged with the other processes using the shared state
+    # after a decrease and otherwise every SYNC_INTERVAL, so that they
+    # behave as one client without touching the file for every request.
+    def __init__(self, state: SharedState = None, maximum: int = DEFAULT_MAX_REQUESTS):
+        self.state = state if state is not None else SharedState()
+        self.maximum = max(1, maximum)
+        self.pid = str(os.getpid())
+        self._limit = float(min(INITIAL_REQUESTS, self.maximum))
+        self._decreased = 0.0
+        self._inflight = 0
+        # Requests in flight in other processes and our own as of the last
+        # exchange
+        self._others = 0
+        self._published = 0
+        self._synced = None
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        with self._cond:
+            return int(self._limit)
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                self._sync_if_due()
+                if self._inflight + self._others < int(self._limit):
+                    self._inflight += 1
+                    return
+                # Slots of other processes are only seen at the next exchange
+                self._cond.wait(min(POLL_MAX, SYNC_INTERVAL))
+
+    def release(self, resp=None, content: bytes = b""):
+        # resp is None if the request didn't get a reply. That says nothing
+        # about the rate.
+        with self._cond:
+            self._inflight = max(0, self._inflight - 1)
+            if resp is None:
+                pass
+            elif resp.status in (403, 429) and is_rate_limit(resp.status, reply_reason(content)):
+                now = time.time()
+                if now - self._decreased > DECREASE_INTERVAL:
+                    self._limit = max(1.0, self._limit * DECREASE_FACTOR)
+                    self._decreased = now
+                    logging.info("Rate limited by Drive. Allowing %d requests at a time.", int(self._limit))
+                    # The other processes should slow down right away, too
+                    self._sync()
+            elif resp.status < 500:
+                self._limit = min(float(self.maximum), self._limit + 1 / self._limit)
+            if self._inflight == 0 and self._published:
+                # Don't keep holding slots of the others while idle
+                self._sync()
+            else:
+                self._sync_if_due()
+            self._cond.notify_all()
+
+    def _sync_if_due(self):
+        if self._synced is None or time.monotonic() - self._synced >= SYNC_INTERVAL:
+            self._sync()
+
+    def _sync(self):
+        with self.state.locked() as data:
+            data['concurrency'] = shared = self._load(data.get('concurrency'))
+            if self._synced is None:
+                self._limit, self._decreased = shared['limit'], shared['decreased']
+            elif shared['decreased'] > self._decreased:
+                # Another process has been rate limited since
+                self._limit = min(self._limit, shared['limit'])
+                self._decreased = shared['decreased']
+            shared['limit'] = self._limit
+            shared['decreased'] = self._decreased
+            if self._inflight:
+                shared['inflight'][self.pid] = self._inflight
+            else:
+                shared['inflight'].pop(self.pid, None)
+            self._published = self._inflight
+            self._others = sum(count for pid, count in shared['inflight'].items() if pid != self.pid)
+        self._synced = time.monotonic()
+
+    def _load(self, state: dict) -> dict:
+        try:
+            state['limit'] = min(float(self.maximum), max(1.0, float(state['limit'])))
+            state['decreased'] = float(state['decreased'])
+            inflight = {pid: int(count) for pid, count in state['inflight'].items()}
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self._new_state()
+        # Requests of processes which have died without releasing them
+        state['inflight'] = {pid: count for pid, count in inflight.items()
+                                if count > 0 and (pid == self.pid or _alive(int(pid)))}
+        return state
+
+    def _new_state(self) -> dict:
+        return {'limit': float(min(INITIAL_REQUESTS, self.maximum)), 'decreased': 0.0, 'inflight': dict()}
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class TokenBucket():
+    # Holds up to capacity tokens and gains rate tokens per second. Taking
+    # more than there are waits until they have been gained. The bucket may
+    # be shared by several processes through the state.
+    def __init__(self, state: SharedState, name: str, rate: float, capacity: float):
+        self.state = state
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+
+    def take(self, amount: float, max_wait: float = None):
+        while True:
+            with self.state.locked() as data:
+                now = time.time()
+                bucket = data.get(self.name)
+                try:
+                    tokens = min(self.capacity, float(bucket['tokens']) + (now - float(bucket['time'])) * self.rate)
+                except (TypeError, KeyError, ValueError):
+                    tokens = self.capacity
+                # Amounts bigger than the bucket go through once it is full
+                if tokens >= min(amount, self.capacity):
+                    tokens -= amount
+                    wait = 0
+                else:
+                    wait = (min(amount, self.capacity) - tokens) / self.rate
+                data[self.name] = {'tokens': tokens, 'time': now}
+            if not wait:
+                return
+            if max_wait is not None and wait > max_wait:
+                raise BudgetExhaustedError(wait)
+            time.sleep(min(wait, POLL_MAX))
+
+class RateLimiter():
+    # Keeps the requests per second and the uploaded bytes per day of all
+    # processes sharing the state within the configured budgets. A budget
+    # of None is unlimited.
+    def __init__(self, state: SharedState = None, qps: float = None, bytes_per_day: int = None):
+        state = state if state is not None else SharedState()
+        self.requests = TokenBucket(state, 'requests', qps, max(1.0, qps)) if qps else None
+        self.upload = TokenBucket(state, 'upload', bytes_per_day / DAY, bytes_per_day) if bytes_per_day else None
+
+    def request(self, upload_bytes: int = 0):
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.upload is not None and upload_bytes:
+            try:
+                self.upload.take(upload_bytes, max_wait=MAX_BUDGET_WAIT)
+            except BudgetExhaustedError as e:
+                raise BudgetExhaustedError(
+                        "Daily upload budget of {} used up. Available again in {}.".format(
+                            format_size(self.upload.capacity, binary=True), format_timespan(e.args[0]))
+                        ) from None
+
+class UploadQuota():
+    # Keeps track of the bytes uploaded within the last 24 hours, in hourly
+    # slots. Once Drive refuses uploads because of its daily limit, further
+    # uploads fail right away until the oldest of those bytes have left the
+    # window, instead of being retried in vain.
+    def __init__(self, state: SharedState = None):
+        self.state = state if state is not None else SharedState()
+
+    def check(self):
+        with self._locked_quota() as quota:
+            blocked_until = quota['blocked_until']
+            uploaded = sum(quota['hours'].values())
+        if blocked_until > time.time():
+            raise UploadQuotaExceededError(
+                    "Daily upload limit of Google Drive reached ({} uploaded in the last 24h)."
+                    " Quota resets at {}.".format(
+                        format_size(uploaded, binary=True),
+                        datetime.fromtimestamp(blocked_until).strftime("%Y-%m-%d %H:%M"))
+                    )
+
+    def update(self, resp, content: bytes, nbytes: int):
+        # Called with the reply to every upload request. Raises if it says
+        # that the limit has been reached.
+        if resp.status in (200, 201, 308):
+            with self._locked_quota() as quota:
+                hour = str(int(time.time() // HOUR))
+                quota['hours'][hour] = quota['hours'].get(hour, 0) + nbytes
+        elif is_upload_limit(resp, content):
+            with self._locked_quota() as quota:
+                if quota['hours']:
+                    oldest = min(int(hour) for hour in quota['hours'])
+                    quota['blocked_until'] = (oldest + 1) * HOUR + DAY
+                else:
+                    quota['blocked_until'] = time.time() + DAY
+                logging.warning("Daily upload limit reached after %s in the last 24h",
+                                    format_size(sum(quota['hours'].values()), binary=True))
+            self.check()
+
+    @contextmanager
+    def _locked_quota(self):
+        with self.state.locked() as data:
+            quota = data.get('upload_quota')
+            try:
+                blocked_until = float(quota['blocked_until'])
+                hours = {hour: int(nbytes) for hour, nbytes in quota['hours'].items()}
+            except (TypeError, KeyError, ValueError, AttributeError):
+                blocked_until, hours = 0.0, dict()
+            # Slots which have left the window
+            first_hour = int((time.time() - DAY) // HOUR) + 1
+            data['upload_quota'] = quota = {
+                'blocked_until': blocked_until,
+                'hours': {hour: nbytes for hour, nbytes in hours.items() if int(hour) >= first_hour},
+            }
+            yield quota
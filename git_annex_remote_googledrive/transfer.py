@@ -0,0 +1,686 @@
+# Copyright (C) 2017-2020  Silvio Ankermann
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of version 3 of the GNU
+# General Public License as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+
+import os
+import json
+import time
+import hashlib
+import queue
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from os import PathLike
+from typing import Union
+
+from drivelib import GoogleDrive
+from drivelib import DriveFile
+from drivelib import CheckSumError
+from drivelib import ResumableMediaUploadProgress, MediaDownloadProgress
+from drivelib.errors import GoogleDriveAPIError
+
+from googleapiclient.errors import HttpError
+
+from .index import KeyIndex
+from .backends import KeyDigest
+from .retrying import call_with_retry
+
+import logging
+
+# The reply to the last chunk carries the checksum, so the upload can be
+# verified without another request
+UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable&fields=id,name,md5Checksum"
+MULTIPART_URL = "https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart&fields=id,name,md5Checksum"
+DOWNLOAD_URL = "https://www.googleapis.com/drive/v3/files/{}?alt=media"
+
+# Drive only accepts chunks of resumable uploads in multiples of 256KiB
+CHUNK_ALIGNMENT = 256*1024
+MIN_CHUNKSIZE = CHUNK_ALIGNMENT
+MAX_CHUNKSIZE = 512*1024**2
+DEFAULT_CHUNKSIZE = 5*1024**2
+# Without any history, big files start with bigger chunks, up to this size
+MAX_INITIAL_CHUNKSIZE = 64*1024**2
+# Chunks should take about this many seconds. Long enough for the overhead
+# of a request not to matter, short enough not to lose much on a failure.
+TARGET_CHUNK_TIME = 5
+# Weight of a new measurement in the throughput average
+SMOOTHING = 0.3
+DEFAULT_CONNECTIONS = 4
+# Smaller files are downloaded over a single connection
+PARALLEL_MIN_SIZE = 32*1024**2
+# Memory an upload may use for chunks read ahead of the one being sent, and
+# a download for the parts in flight
+DEFAULT_BUFFER_SIZE = 64*1024**2
+# Files up to this size are uploaded with a single request
+MULTIPART_MAX_SIZE = 5*1024**2
+
+def align(size: int) -> int:
+    size = int(size) - int(size) % CHUNK_ALIGNMENT
+    return max(MIN_CHUNKSIZE, min(MAX_CHUNKSIZE, size))
+
+class ThroughputStats():
+    # Average throughput of recent transfers in bytes per second, by
+    # direction. Kept in the key index so the next process starts with it.
+    def __init__(self, index: KeyIndex = None):
+        self.index = index
+        self._rates = dict()
+        self._lock = threading.Lock()
+
+    def get(self, direction: str) -> float:
+        with self._lock:
+            if direction not in self._rates and self.index is not None:
+                rate = self.index.get_state("throughput_" + direction)
+                self._rates[direction] = float(rate) if rate is not None else None
+            return self._rates.get(direction)
+
+    def update(self, direction: str, rate: float):
+        old_rate = self.get(direction)
+        if old_rate is not None:
+            rate = SMOOTHING * rate + (1 - SMOOTHING) * old_rate
+        with self._lock:
+            self._rates[direction] = rate
+            if self.index is not None:
+                self.index.set_state("throughput_" + direction, str(rate))
+
+class ChunkSizer():
+    # Picks the size of each chunk of a transfer. A fixed chunksize is used
+    # as is, otherwise chunks are sized to take about TARGET_CHUNK_TIME.
+    def __init__(self, stats: ThroughputStats, direction: str, total_size: int, chunksize: int = None):
+        self.stats = stats
+        self.direction = direction
+        self.fixed = bool(chunksize)
+        self.rate = stats.get(direction)
+        # Shared by all connections of a parallel download
+        self._lock = threading.Lock()
+        if chunksize:
+            self.chunksize = chunksize
+        elif self.rate:
+            self.chunksize = align(self.rate * TARGET_CHUNK_TIME)
+        else:
+            self.chunksize = align(min(max(DEFAULT_CHUNKSIZE, total_size // 100), MAX_INITIAL_CHUNKSIZE))
+
+    def next_size(self, remaining: int) -> int:
+        return min(self.chunksize, remaining)
+
+    def record(self, nbytes: int, seconds: float):
+        if seconds <= 0:
+            return
+        rate = nbytes / seconds
+        self.stats.update(self.direction, rate)
+        if self.fixed:
+            return
+        with self._lock:
+            self._adapt(rate)
+
+    def _adapt(self, rate: float):
+        self.rate = rate if self.rate is None else SMOOTHING * rate + (1 - SMOOTHING) * self.rate
+        # Change gradually so a single outlier can't throw it off
+        chunksize = align(self.rate * TARGET_CHUNK_TIME)
+        chunksize = max(self.chunksize // 2, min(self.chunksize * 2, chunksize))
+        if chunksize != self.chunksize:
+            logging.debug("Changing %s chunksize from %d to %d", self.direction, self.chunksize, align(chunksize))
+        self.chunksize = align(chunksize)
+
+    def failed(self):
+        if not self.fixed:
+            with self._lock:
+                self.chunksize = align(self.chunksize // 2)
+
+class ResumableUpload():
+    # Uploads a new file in chunks. The chunksize may change between chunks.
+    # The MD5 is computed from the chunks as they are sent, so the file is
+    # read only once. It is compared with Drive's and, if the key has one,
+    # with the key's MD5. The next chunks are read while the current one is
+    # being sent.
+    def __init__(self, remote_file: DriveFile, local_filename: str, stats: ThroughputStats,
+                    chunksize: int = None, resumable_uri: str = None, md5sum: str = None,
+                    buffer_size: int = DEFAULT_BUFFER_SIZE, progress_handler: callable = None):
+        self.file = remote_file
+        self.drive = remote_file.drive
+        self.local_filename = local_filename
+        self.resumable_uri = resumable_uri
+        self.progress_handler = progress_handler
+        self.total_size = os.path.getsize(local_filename)
+        self.sizer = ChunkSizer(stats, "upload", self.total_size, chunksize)
+        self.expected_md5 = md5sum
+        self.md5 = hashlib.md5()
+        self.md5sum = None
+        self.buffer_size = buffer_size
+        self.interrupted = False
+
+    def run(self):
+        if self.file.id:
+            raise FileExistsError("Uploading new revision not yet implemented")
+        if self.total_size == 0:
+            self.file.upload_empty()
+            self.md5sum = hashlib.md5().hexdigest()
+            return
+
+        with open(self.local_filename, 'rb') as fh:
+            if self.resumable_uri:
+                done, content = call_with_retry(self._query_progress, fh)
+            else:
+                self.resumable_uri = call_with_retry(self._start_session)
+                done, content = False, None
+                self.progress = 0
+            self._report()
+
+            if not done:
+                done, content = call_with_retry(self._send_chunks, fh)
+
+        self.progress = self.total_size
+        self._finish(content)
+
+    def _send_chunks(self, fh) -> tuple:
+        # Sends the rest of the file. After a failed chunk, the session is
+        # asked first how much of it has arrived, so a retry continues from
+        # there.
+        if self.interrupted:
+            done, content = self._query_progress(fh)
+            self.interrupted = False
+            if done:
+                return done, content
+            self._report()
+
+        reader = ReadAhead(fh, self.progress, self.total_size, self.sizer, self.buffer_size)
+        try:
+            while True:
+                chunk = reader.get()
+                start = time.monotonic()
+                try:
+                    done, content = self._put_chunk(chunk)
+                except:
+                    self.sizer.failed()
+                    self.interrupted = True
+                    raise
+                self.sizer.record(len(chunk), time.monotonic() - start)
+                reader.release(len(chunk))
+                self.progress += len(chunk)
+                if done:
+                    return done, content
+                self._report()
+        finally:
+            reader.close()
+
+    def _report(self):
+        if self.progress_handler:
+            self.progress_handler(ResumableMediaUploadProgress(self.progress, self.total_size, self.resumable_uri))
+
+    def _start_session(self) -> str:
+        body = {
+            'name': self.file.name,
+            'parents': list(self.file.parent_ids),
+        }
+        resp, content = self.drive.service._http.request(UPLOAD_URL, method='POST',
+                            headers={'Content-Type': 'application/json; charset=UTF-8'},
+                            body=json.dumps(body))
+        if resp.status != 200:
+            raise GoogleDriveAPIError.from_reply(resp, content)
+        return resp['location']
+
+    def _query_progress(self, fh) -> tuple:
+        resp, content = self.drive.service._http.request(self.resumable_uri, method='PUT',
+                            headers={'Content-Length': '0', 'Content-Range': 'bytes */{}'.format(self.total_size)})
+        if resp.status in (200, 201):
+            # Already complete
+            self.progress = self.total_size
+            self._hash_prefix(fh, self.total_size)
+            return True, content
+        if resp.status != 308:
+            raise GoogleDriveAPIError.from_reply(resp, content)
+        self.progress = int(resp['range'].split("-")[1])+1 if 'range' in resp else 0
+        self._hash_prefix(fh, self.progress)
+        self._check_range_md5(resp)
+        return False, None
+
+    def _hash_prefix(self, fh, length: int):
+        self.md5 = hashlib.md5()
+        fh.seek(0)
+        while length > 0:
+            data = fh.read(min(length, DEFAULT_CHUNKSIZE))
+            if not data:
+                break
+            self.md5.update(data)
+            length -= len(data)
+
+    def _put_chunk(self, chunk: bytes) -> tuple:
+        end = self.progress + len(chunk)
+        resp, content = self.drive.service._http.request(self.resumable_uri, method='PUT',
+                            headers={
+                                'Content-Length': str(len(chunk)),
+                                'Content-Range': 'bytes {}-{}/{}'.format(self.progress, end-1, self.total_size),
+                            },
+                            body=chunk)
+        if resp.status not in (200, 201, 308):
+            raise GoogleDriveAPIError.from_reply(resp, content)
+        self.md5.update(chunk)
+        if resp.status == 308:
+            self._check_range_md5(resp)
+            return False, content
+        return True, content
+
+    def _check_range_md5(self, resp):
+        if 'x-range-md5' in resp and resp['x-range-md5'] != self.md5.hexdigest():
+            raise CheckSumError("Checksum mismatch. Need to repeat upload.")
+
+    def _finish(self, content: bytes):
+        result = json.loads(content)
+        remote_md5 = result.get('md5Checksum')
+        if remote_md5 is None:
+            # Session was started without asking for it
+            try:
+                remote_md5 = self.drive.service.files().get(fileId=result['id'], fields="md5Checksum").execute()['md5Checksum']
+            except HttpError as e:
+                if e.resp.status == 404:
+                    raise FileNotFoundError("File was successfully uploaded but since has been deleted")
+                raise GoogleDriveAPIError.from_http_error(e)
+        check_upload(self.drive, result['id'], self.md5.hexdigest(), remote_md5, self.expected_md5)
+        self.md5sum = remote_md5
+        self.file.id = result['id']
+        self.file.name = result['name']
+        self.file.resumable_uri = None
+
+def check_upload(drive: GoogleDrive, file_id: str, local_md5: str, remote_md5: str, expected_md5: str = None):
+    # Compares what was sent with what Drive got and what the key says. On
+    # a mismatch, the uploaded file is removed, so no broken copy is left
+    # behind for the next attempt to trip over.
+    if expected_md5 is not None and local_md5 != expected_md5:
+        error = LocalContentMismatchError("Content does not match key. Its MD5 is {}.".format(local_md5))
+    elif remote_md5 != local_md5:
+        error = CheckSumError("Checksum mismatch. Need to repeat upload.")
+    else:
+        return
+    try:
+        drive.service.files().delete(fileId=file_id).execute()
+    except HttpError:
+        logging.warning("Could not remove %s after failed upload", file_id)
+    raise error
+
+class MultipartUpload():
+    # Uploads a small file with a single request carrying both metadata and
+    # content. Nothing is left to resume if it fails.
+    def __init__(self, remote_file: DriveFile, local_filename: str, md5sum: str = None):
+        self.file = remote_file
+        self.drive = remote_file.drive
+        self.local_filename = local_filename
+        self.total_size = os.path.getsize(local_filename)
+        self.expected_md5 = md5sum
+        self.md5sum = None
+
+    def run(self):
+        if self.file.id:
+            raise FileExistsError("Uploading new revision not yet implemented")
+        if self.total_size == 0:
+            self.file.upload_empty()
+            self.md5sum = hashlib.md5().hexdigest()
+            return
+        with open(self.local_filename, 'rb') as fh:
+            content = fh.read()
+        local_md5 = hashlib.md5(content).hexdigest()
+
+        boundary = uuid.uuid4().hex
+        metadata = json.dumps({
+            'name': self.file.name,
+            'parents': list(self.file.parent_ids),
+        })
+        body = b"".join((
+            "--{}\r\n".format(boundary).encode(),
+            b"Content-Type: application/json; charset=UTF-8\r\n\r\n",
+            metadata.encode(), b"\r\n",
+            "--{}\r\n".format(boundary).encode(),
+            b"Content-Type: application/octet-stream\r\n\r\n",
+            content, b"\r\n",
+            "--{}--".format(boundary).encode(),
+        ))
+        resp, reply = self.drive.service._http.request(MULTIPART_URL, method='POST',
+                            headers={
+                                'Content-Type': 'multipart/related; boundary={}'.format(boundary),
+                                'Content-Length': str(len(body)),
+                            },
+                            body=body)
+        if resp.status not in (200, 201):
+            raise GoogleDriveAPIError.from_reply(resp, reply)
+
+        result = json.loads(reply)
+        check_upload(self.drive, result['id'], local_md5, result.get('md5Checksum'), self.expected_md5)
+        self.md5sum = local_md5
+        self.file.id = result['id']
+        self.file.name = result['name']
+
+class ReadAhead():
+    # Reads the chunks of an upload in a separate thread, so reading the next
+    # chunk overlaps with sending the current one. Chunks stay in memory
+    # until they are released, and never more than buffer_size bytes at once.
+    # Chunks are kept to at most half of that, so there is always room for
+    # the next one.
+    def __init__(self, fh, start: int, total_size: int, sizer: ChunkSizer, buffer_size: int):
+        self.fh = fh
+        self.position = start
+        self.total_size = total_size
+        self.sizer = sizer
+        self.buffer_size = buffer_size
+        self.max_chunksize = max(MIN_CHUNKSIZE, align(buffer_size // 2))
+        self.buffered = 0
+        self.closed = False
+        self.chunks = queue.Queue()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def get(self) -> bytes:
+        chunk = self.chunks.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+    def release(self, length: int):
+        with self._cond:
+            self.buffered -= length
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        try:
+            self.fh.seek(self.position)
+            while self.position < self.total_size:
+                length = min(self.sizer.next_size(self.total_size - self.position), self.max_chunksize)
+                with self._cond:
+                    while self.buffered > 0 and self.buffered + length > self.buffer_size and not self.closed:
+                        self._cond.wait()
+                    if self.closed:
+                        return
+                    self.buffered += length
+                chunk = self.fh.read(length)
+                if len(chunk) != length:
+                    raise IOError("{} changed during upload".format(self.fh.name))
+                self.chunks.put(chunk)
+                self.position += length
+        except Exception as e:
+            self.chunks.put(e)
+
+class StreamVerifier():
+    # Hashes the content of a download in order while it comes in. Chunks
+    # arriving in order are hashed right away. Parts that were fetched ahead
+    # of it are read back from the file, where they have just been written,
+    # once the gap before them is closed.
+    def __init__(self, filename: str, expected: dict):
+        self.filename = filename
+        self.hashes = {name: (new(), hexdigest) for name, (new, hexdigest) in expected.items()}
+        self.position = 0
+
+    def update(self, done: list, offset: int = None, content: bytes = None):
+        if offset == self.position:
+            self._hash(content)
+        if not done or done[0][0] != 0 or done[0][1] <= self.position:
+            return
+        with open(self.filename, 'rb') as fh:
+            fh.seek(self.position)
+            while self.position < done[0][1]:
+                data = fh.read(min(DEFAULT_CHUNKSIZE, done[0][1] - self.position))
+                if not data:
+                    break
+                self._hash(data)
+
+    def mismatch(self) -> str:
+        # Returns the name of the first hash that doesn't match or None
+        for name, (hasher, hexdigest) in self.hashes.items():
+            if hasher.hexdigest() != hexdigest:
+                logging.debug("Expected %s %s, got %s", name, hexdigest, hasher.hexdigest())
+                return name
+        return None
+
+    def _hash(self, data: bytes):
+        for hasher, _ in self.hashes.values():
+            hasher.update(data)
+        self.position += len(data)
+
+class ContentMismatchError(CheckSumError):
+    # The remote file itself doesn't match the key, so downloading it again
+    # won't help
+    pass
+
+class LocalContentMismatchError(CheckSumError):
+    # The local file doesn't match the key, so uploading it again won't help
+    pass
+
+class DownloadState():
+    # Remembers which parts of a download are done, so it can be continued
+    # after the process was restarted
+    def __init__(self, state_file: Union[str, PathLike] = None):
+        self.state_file = Path(state_file) if state_file is not None else None
+
+    def load(self) -> dict:
+        if self.state_file is None:
+            return None
+        try:
+            with self.state_file.open('r') as fh:
+                return json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, file_id: str, md5: str, size: int, done: list):
+        if self.state_file is None:
+            return
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.state_file.with_name(self.state_file.name + ".tmp")
+        with tmp_file.open('w') as fh:
+            json.dump({'file_id': file_id, 'md5': md5, 'size': size, 'done': done}, fh)
+        os.replace(str(tmp_file), str(self.state_file))
+
+    def clear(self):
+        if self.state_file is not None:
+            self.state_file.unlink(missing_ok=True)
+
+class ChunkedDownload():
+    # Downloads a file in chunks using range requests. The chunksize may
+    # change between chunks and big files are fetched over several
+    # connections at once. Parts that are done are recorded, so an
+    # interrupted download continues where it stopped as long as the remote
+    # file is unchanged. The content is checked against Drive's MD5 and the
+    # hash of the key while it comes in. Every part is held in memory until
+    # it is written, so their size is limited by the buffer size.
+    def __init__(self, remote_file: DriveFile, local_filename: str, stats: ThroughputStats,
+                    chunksize: int = None, connections: int = 1, state_file: Union[str, PathLike] = None,
+                    digest: KeyDigest = None, progress_handler: callable = None,
+                    buffer_size: int = DEFAULT_BUFFER_SIZE):
+        self.file = remote_file
+        self.drive = remote_file.drive
+        self.local_filename = local_filename
+        self.stats = stats
+        self.chunksize = chunksize
+        self.connections = connections
+        self.state = DownloadState(state_file)
+        self.digest = digest
+        self.progress_handler = progress_handler
+        self.buffer_size = buffer_size
+        self.url = DOWNLOAD_URL.format(remote_file.id)
+
+    def run(self):
+        meta = self.file.meta_get("size, md5Checksum")
+        total_size = int(meta['size'])
+        md5sum = meta['md5Checksum']
+        if self.digest is not None and self.digest.backend == "MD5" and md5sum != self.digest.hexdigest:
+            # No need to download anything to know it's wrong
+            raise ContentMismatchError("Remote file doesn't match the key. Its MD5 is {}.".format(md5sum))
+        sizer = ChunkSizer(self.stats, "download", total_size, self.chunksize)
+
+        done = self._resume(total_size, md5sum)
+        if done is None:
+            done = list()
+            with open(self.local_filename, 'wb') as fh:
+                fh.truncate(total_size)
+        self.state.save(self.file.id, md5sum, total_size, done)
+
+        expected = {"MD5": (hashlib.md5, md5sum)}
+        if self.digest is not None:
+            expected[self.digest.backend] = (self.digest.new, self.digest.hexdigest)
+        verifier = StreamVerifier(self.local_filename, expected)
+        verifier.update(done)
+
+        missing = missing_ranges(done, total_size)
+        if missing:
+            connections = self.connections if total_size >= PARALLEL_MIN_SIZE else 1
+            self._fetch_ranges(missing, sizer, connections, done, total_size, md5sum, verifier)
+
+        mismatch = verifier.mismatch()
+        self.state.clear()
+        if mismatch:
+            os.remove(self.local_filename)
+            raise CheckSumError("{} checksum mismatch. Need to repeat download.".format(mismatch))
+
+    def _resume(self, total_size: int, md5sum: str) -> list:
+        # Returns the parts that are already done or None if there is nothing
+        # to continue from
+        state = self.state.load()
+        if state is None:
+            return None
+        if (state.get('file_id'), state.get('md5'), state.get('size')) != (self.file.id, md5sum, total_size):
+            logging.info("Remote file changed since the download was interrupted. Starting over.")
+            return None
+        try:
+            if os.path.getsize(self.local_filename) != total_size:
+                return None
+        except FileNotFoundError:
+            return None
+        done = [tuple(r) for r in state['done']]
+        logging.info("Continuing download of %s with %d of %d bytes done",
+                        self.file.name, sum(end-start for start, end in done), total_size)
+        return done
+
+    def _fetch_ranges(self, missing: list, sizer: ChunkSizer, connections: int, done: list, total_size: int, md5sum: str,
+                        verifier: StreamVerifier):
+        connections = max(1, min(connections, RangeQueue(missing, sizer).count()))
+        # Each connection holds the part it is fetching and may have one
+        # more waiting to be hashed
+        max_size = align(self.buffer_size // (2 * connections))
+        ranges = RangeQueue(missing, sizer, max_size)
+        results = queue.Queue(maxsize=connections)
+        def worker():
+            try:
+                with open(self.local_filename, 'r+b') as fh:
+                    for offset, length in ranges:
+                        content = call_with_retry(self._fetch, offset, length, sizer)
+                        fh.seek(offset)
+                        fh.write(content)
+                        fh.flush()
+                        results.put((offset, content))
+            except Exception as e:
+                ranges.abort()
+                results.put(e)
+            finally:
+                results.put(None)
+
+        if connections > 1:
+            logging.debug("Downloading %s over %d connections", self.file.name, connections)
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            for _ in range(connections):
+                executor.submit(worker)
+            # Progress is reported from this thread only, as it is the one
+            # git-annex is talking to. After an error, what the other
+            # connections finish before they stop is kept.
+            progress = sum(end-start for start, end in done)
+            self._report(progress, total_size)
+            error = None
+            finished = 0
+            while finished < connections:
+                result = results.get()
+                if result is None:
+                    finished += 1
+                    continue
+                if isinstance(result, Exception):
+                    error = error or result
+                    continue
+                offset, content = result
+                add_range(done, offset, offset+len(content))
+                verifier.update(done, offset, content)
+                self.state.save(self.file.id, md5sum, total_size, done)
+                progress += len(content)
+                self._report(progress, total_size)
+
+        if error is not None:
+            raise error
+
+    def _fetch(self, offset: int, length: int, sizer: ChunkSizer) -> bytes:
+        start = time.monotonic()
+        try:
+            resp, content = self.drive.service._http.request(self.url,
+                                headers={'Range': 'bytes={}-{}'.format(offset, offset+length-1)})
+        except:
+            sizer.failed()
+            raise
+        if resp.status != 206:
+            sizer.failed()
+            raise GoogleDriveAPIError.from_reply(resp, content)
+        sizer.record(len(content), time.monotonic() - start)
+        return content
+
+    def _report(self, progress: int, total_size: int):
+        if self.progress_handler:
+            self.progress_handler(MediaDownloadProgress(progress, total_size))
+
+class RangeQueue():
+    # Hands out the missing parts of a file, cut into chunks of at most
+    # max_size, to the threads downloading it
+    def __init__(self, missing: list, sizer: ChunkSizer, max_size: int = None):
+        self.missing = list(missing)
+        self.sizer = sizer
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def count(self) -> int:
+        size = min(self.sizer.chunksize, self.max_size or self.sizer.chunksize)
+        return sum(-(-(end-start) // size) for start, end in self.missing)
+
+    def __iter__(self):
+        while True:
+            with self._lock:
+                if not self.missing:
+                    return
+                start, end = self.missing[0]
+                length = self.sizer.next_size(end - start)
+                if self.max_size is not None:
+                    length = min(length, self.max_size)
+                if start + length >= end:
+                    self.missing.pop(0)
+                else:
+                    self.missing[0] = (start + length, end)
+            yield start, length
+
+    def abort(self):
+        with self._lock:
+            self.missing = list()
+
+def add_range(ranges: list, start: int, end: int):
+    # Adds [start, end) to a sorted list of non-overlapping ranges, merging
+    # adjacent ones
+    ranges.append((start, end))
+    ranges.sort()
+    merged = list()
+    for range_start, range_end in ranges:
+        if merged and range_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+        else:
+            merged.append((range_start, range_end))
+    ranges[:] = merged
+
+def missing_ranges(done: list, total_size: int) -> list:
+    missing = list()
+    offset = 0
+    for start, end in sorted(done):
+        if start > offset:
+            missing.append((offset, start))
+        offset = max(offset, end)
+    if offset < total_size:
+        missing.append((offset, total_size))
+    return missing
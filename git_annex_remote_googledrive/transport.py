@@ -0,0 +1,154 @@
+# Copyright (C) 2017-2020  Silvio Ankermann
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of version 3 of the GNU
+# General Public License as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+
+import threading
+from urllib.parse import urlparse
+
+from drivelib import GoogleDrive
+
+import google_auth_httplib2
+
+from .throttle import ConcurrencyController, RateLimiter, UploadQuota, is_upload_limit
+
+DEFAULT_POOL_SIZE = 32
+DEFAULT_PER_HOST = 32
+# Requests to URLs containing this carry file content
+UPLOAD_PATH = "/upload/drive/"
+
+# Limits for pools created from now on. Set once by the remote from its
+# configuration.
+_limits = {'size': DEFAULT_POOL_SIZE, 'per_host': DEFAULT_PER_HOST, 'controller': None, 'rate_limiter': None,
+            'quota': None}
+# One pool per set of credentials, so everything in the process shares it
+_pools = dict()
+_pools_lock = threading.Lock()
+
+def configure(size: int = DEFAULT_POOL_SIZE, per_host: int = DEFAULT_PER_HOST,
+                controller: ConcurrencyController = None, rate_limiter: RateLimiter = None,
+                quota: UploadQuota = None):
+    _limits['size'] = max(1, size)
+    _limits['per_host'] = max(1, per_host)
+    _limits['controller'] = controller
+    _limits['rate_limiter'] = rate_limiter
+    _limits['quota'] = quota
+
+def new_http(creds) -> google_auth_httplib2.AuthorizedHttp:
+    http = google_auth_httplib2.AuthorizedHttp(creds)
+    # see https://github.com/googleapis/google-api-python-client/issues/803#issuecomment-578151576
+    http.http.redirect_codes = set(http.http.redirect_codes) - {308}
+    return http
+
+class ConnectionPool():
+    # Stands in for the http object of a service. httplib2 connections must
+    # not be used by two threads at once, so every request borrows one of a
+    # set of authorized connections and returns it afterwards. Idle ones are
+    # kept alive, and the most recently used one is handed out first. The
+    # controller, if any, decides how many requests may be in flight and
+    # the rate limiter how many may be sent per second. The quota sees all
+    # uploads.
+    def __init__(self, creds, size: int = DEFAULT_POOL_SIZE, per_host: int = DEFAULT_PER_HOST,
+                    controller: ConcurrencyController = None, rate_limiter: RateLimiter = None,
+                    quota: UploadQuota = None):
+        self.creds = creds
+        self.size = size
+        self.per_host = per_host
+        self.controller = controller
+        self.rate_limiter = rate_limiter
+        self.quota = quota
+        self.requests = 0
+        self.opened = 0
+        self.reused = 0
+        self._template = new_http(creds)
+        self._idle = [self._template]
+        self._created = 1
+        self._active = dict()
+        self._cond = threading.Condition()
+
+    def __getattr__(self, name):
+        # Anything but request, e.g. credentials for batch requests
+        return getattr(self._template, name)
+
+    def request(self, uri, *args, **kwargs):
+        uploading = UPLOAD_PATH in uri
+        body = kwargs.get('body', args[1] if len(args) > 1 else None)
+        upload_bytes = len(body) if uploading and isinstance(body, bytes) else 0
+        if uploading and self.quota is not None:
+            self.quota.check()
+        if self.rate_limiter is not None:
+            self.rate_limiter.request(upload_bytes=upload_bytes)
+        resp, content = self._limited_request(uploading, uri, *args, **kwargs)
+        if uploading and self.quota is not None:
+            self.quota.update(resp, content, upload_bytes)
+        return resp, content
+
+    def _limited_request(self, uploading, uri, *args, **kwargs):
+        if self.controller is None:
+            return self._request(uri, *args, **kwargs)
+        self.controller.acquire()
+        resp, content = None, b""
+        try:
+            resp, content = self._request(uri, *args, **kwargs)
+            return resp, content
+        finally:
+            if uploading and is_upload_limit(resp, content):
+                # Looks like rate limiting, but sending fewer requests won't help
+                self.controller.release()
+            else:
+                self.controller.release(resp, content)
+
+    def _request(self, uri, *args, **kwargs):
+        parsed = urlparse(uri)
+        http = self._checkout(parsed.netloc)
+        reused = "{}:{}".format(parsed.scheme, parsed.netloc) in http.http.connections
+        try:
+            return http.request(uri, *args, **kwargs)
+        finally:
+            self._checkin(http, parsed.netloc, reused)
+
+    def stats(self) -> str:
+        with self._cond:
+            stats = "{} requests, {} connections opened, {} reused, {} in pool".format(
+                            self.requests, self.opened, self.reused, self._created)
+        if self.controller is not None:
+            stats += ", {} requests at a time allowed".format(self.controller.limit)
+        return stats
+
+    def _checkout(self, host: str):
+        with self._cond:
+            while self._active.get(host, 0) >= self.per_host \
+                    or (not self._idle and self._created >= self.size):
+                self._cond.wait()
+            self._active[host] = self._active.get(host, 0) + 1
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        return new_http(self.creds)
+
+    def _checkin(self, http, host: str, reused: bool):
+        with self._cond:
+            self.requests += 1
+            if reused:
+                self.reused += 1
+            else:
+                self.opened += 1
+            self._active[host] -= 1
+            self._idle.append(http)
+            self._cond.notify_all()
+
+def share_connections(drive: GoogleDrive) -> GoogleDrive:
+    # Requests built by the service (and drivelib, which uses its http
+    # object directly) pick up the replaced http object.
+    if not isinstance(drive.service._http, ConnectionPool):
+        with _pools_lock:
+            if id(drive.creds) not in _pools:
+                _pools[id(drive.creds)] = ConnectionPool(drive.creds, _limits['size'], _limits['per_host'],
+                                                            _limits['controller'], _limits['rate_limiter'],
+                                                            _limits['quota'])
+            drive.service._http = _pools[id(drive.creds)]
+    return drive